@@ -1,8 +1,11 @@
-from flask import Flask, request, jsonify, g, render_template, session, redirect, url_for
+from flask import Flask, request, jsonify, g, render_template, session
 from firebase_admin import auth  # Only use 'auth', no need to initialize Firebase here
 from flask_wtf import CSRFProtect
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from core.rate_limit_storage import check_strategy  # also registers the sqlite:// limiter storage
+from core.auth_utils import SESSION_COOKIE_MODE, SESSION_COOKIE_NAME, create_firebase_session_cookie
+from services.middleware import enforce_auth_policy, public
 from datetime import timedelta
 import os
 import logging
@@ -34,12 +37,17 @@ logger = logging.getLogger(__name__)
 csrf = CSRFProtect()
 csrf.init_app(app)
 
-# Initialize rate limiter
+# Initialize rate limiter; the default sqlite:// storage is shared by all
+# workers on the host, so limits hold under gunicorn (memory:// is per worker)
+rate_limit_storage = os.environ.get('RATE_LIMIT_STORAGE', 'sqlite://')
+app.config['RATELIMIT_STRATEGY'] = os.environ.get('RATELIMIT_STRATEGY', 'fixed-window')
+# Fail at startup rather than on the first rate-limited request
+check_strategy(rate_limit_storage, app.config['RATELIMIT_STRATEGY'])
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=[os.environ.get('RATE_LIMIT_DEFAULT', '200 per day, 50 per hour')],
-    storage_uri=os.environ.get('RATE_LIMIT_STORAGE', 'memory://')
+    storage_uri=rate_limit_storage
 )
 
 # Secure headers middleware
@@ -58,6 +66,7 @@ def add_security_headers(response):
 # Session Login Endpoint
 # =====================
 @app.route('/session-login', methods=['POST'])
+@public
 @csrf.exempt
 def session_login():
     data = request.get_json()
@@ -65,12 +74,17 @@ def session_login():
     if not id_token:
         return jsonify({'error': 'ID token missing'}), 400
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        session_cookie = None
+        if SESSION_COOKIE_MODE:
+            session_cookie, decoded_token, max_age = create_firebase_session_cookie(id_token)
+        else:
+            decoded_token = auth.verify_id_token(id_token)
         uid = decoded_token['uid']
         
         # Store minimal session data; do not treat the raw ID token as the canonical session.
         session.permanent = True
-        session['firebase_id_token'] = id_token
+        if not SESSION_COOKIE_MODE:
+            session['firebase_id_token'] = id_token
         session['uid'] = uid
         
         # Check if this is a new user registration (pending_user in session)
@@ -88,7 +102,13 @@ def session_login():
                     'email': pending['email']
                 })
         
-        return jsonify({'message': 'Login successful'}), 200
+        response = jsonify({'message': 'Login successful'})
+        if session_cookie:
+            response.set_cookie(
+                SESSION_COOKIE_NAME, session_cookie, max_age=max_age, httponly=True,
+                secure=app.config['SESSION_COOKIE_SECURE'], samesite=app.config['SESSION_COOKIE_SAMESITE']
+            )
+        return response, 200
     except Exception as e:
         return jsonify({'error': f'Invalid token: {str(e)}'}), 401
 
@@ -97,35 +117,18 @@ def session_login():
 # =====================
 @app.before_request
 def verify_token():
-    public_endpoints = [
-        'routes.index',
-        'routes.login_page',
-        'routes.register_page',
-        'session_login',
-        'static'
-    ]
-    if request.endpoint in public_endpoints or request.endpoint is None:
+    """Run the one auth check each endpoint declares (see services.middleware)."""
+    # static files and unmatched URLs (404s) need no auth
+    if request.endpoint in (None, 'static'):
         return
-
-    id_token = session.get('firebase_id_token')
-    if not id_token:
-        return redirect(url_for('routes.login_page'))
-
-    try:
-        decoded_token = auth.verify_id_token(id_token)
-        # minimal g context for routes
-        g.uid = decoded_token.get('uid')
-        g.user = decoded_token
-    except Exception:
-        session.clear()
-        return redirect(url_for('routes.login_page'))
+    return enforce_auth_policy(app.view_functions.get(request.endpoint))
 
 # =====================
 # Context processor
 # =====================
 @app.context_processor
 def inject_user():
-    return dict(current_user={'uid': g.get('uid', None)})
+    return dict(current_user={'uid': g.get('uid', None)}, session_cookie_mode=SESSION_COOKIE_MODE)
 
 # =====================
 # Register routes — imported last to avoid circular import
@@ -133,7 +136,11 @@ def inject_user():
 from routes import routes_bp
 app.register_blueprint(routes_bp)
 
+from commands import register_commands
+register_commands(app)
+
 @app.route('/')
+@public
 def home():
     return render_template('index.html')
 
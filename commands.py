@@ -0,0 +1,138 @@
+"""
+Maintenance commands, run through the Flask CLI:
+
+    flask --app main <command>
+"""
+import os
+from datetime import datetime, timedelta
+
+import click
+
+from core.upload_pipeline import sweep_orphaned_proofs
+from core.recommendation_engine import generate_recommendations_for_all_users, JobBusy
+from core.grading_rules import export_rules_json
+from core.verification_engine import verify_all_users
+from services.models import (
+    sweep_expired_events, sweep_expired_user_recommendations, normalize_event_dates, fail_stale_proof_uploads,
+    iter_user_pages, recompute_user_credits
+)
+
+
+@click.command('sweep-proofs')
+@click.option('--limit', default=500, show_default=True, help='Maximum orphaned proofs to remove per batch.')
+@click.option('--stale-minutes', default=60, show_default=True,
+              help="Mark background uploads still 'uploading' after this long as failed.")
+def sweep_proofs_command(limit, stale_minutes):
+    """Delete proof files no longer referenced by any activity."""
+    stale = fail_stale_proof_uploads(datetime.utcnow() - timedelta(minutes=stale_minutes))
+    if stale:
+        click.echo(f"Marked {stale} stale proof upload(s) as failed.")
+    total = 0
+    while True:
+        removed = sweep_orphaned_proofs(limit)
+        total += removed
+        if removed < limit:
+            break
+    click.echo(f"Removed {total} orphaned proof file(s).")
+
+
+@click.command('generate-recommendations')
+@click.option('--workers', default=8, show_default=True, help='Concurrent users processed.')
+@click.option('--page-size', default=200, show_default=True, help='Users read per page.')
+@click.option('--resume/--restart', default=True, show_default=True, help='Continue an interrupted run from its checkpoint.')
+def generate_recommendations_command(workers, page_size, resume):
+    """Generate recommendations for every user (daily job)."""
+    try:
+        result = generate_recommendations_for_all_users(workers=workers, page_size=page_size, resume=resume)
+    except JobBusy as e:
+        raise click.ClickException(str(e))
+    click.echo(
+        f"Processed {result['processed']} user(s) in {result['elapsed_seconds']}s: "
+        f"{result['with_recommendations']} with recommendations "
+        f"({result['recommendations']} total), {result['failed']} failed."
+    )
+
+
+@click.command('sweep-expired')
+def sweep_expired_command():
+    """Delete past events and expired user recommendations (run on a schedule)."""
+    events_deleted, events_failed = sweep_expired_events()
+    recs_deleted, recs_failed = sweep_expired_user_recommendations()
+    click.echo(f"Events: {events_deleted} deleted, {events_failed} failed.")
+    click.echo(f"User recommendations: {recs_deleted} deleted, {recs_failed} failed.")
+
+
+@click.command('normalize-event-dates')
+def normalize_event_dates_command():
+    """Convert events stored with ISO-string dates to timestamps (one-off migration)."""
+    updated, unparseable = normalize_event_dates()
+    click.echo(f"Events: {updated} date(s) converted, {unparseable} could not be parsed.")
+
+
+@click.command('recompute-credits')
+@click.option('--uid', default=None, help='Only repair this user.')
+def recompute_credits_command(uid):
+    """Rebuild credits and certificate totals from activities (repair for drifted increments)."""
+    if uid:
+        total = recompute_user_credits(uid)
+        click.echo(f"{uid}: {total} credit(s).")
+        return
+    repaired = failed = 0
+    for page in iter_user_pages(fields=()):
+        for user in page:
+            try:
+                recompute_user_credits(user['uid'])
+                repaired += 1
+            except Exception as e:
+                failed += 1
+                click.echo(f"{user['uid']}: {e}", err=True)
+    click.echo(f"Recomputed credits for {repaired} user(s), {failed} failed.")
+
+
+@click.command('export-grading-rules')
+@click.option('--output', default=os.path.join('n8n', 'grading_rules.json'), show_default=True,
+              help='Where to write the rule table.')
+def export_grading_rules_command(output):
+    """Write the grading rule table as JSON for the n8n auto-grade workflow."""
+    with open(output, 'w', encoding='utf-8') as f:
+        f.write(export_rules_json() + '\n')
+    click.echo(f"Wrote grading rules to {output}.")
+
+
+@click.command('verify-all')
+@click.option('--workers', default=8, show_default=True, help='Concurrent users processed.')
+@click.option('--page-size', default=200, show_default=True, help='Users read per page.')
+@click.option('--writes-per-second', default=400, show_default=True,
+              help='Cap on Firestore document writes across all workers (0 = unlimited).')
+@click.option('--full', is_flag=True, help='Re-grade every activity, e.g. after a grading rule change.')
+@click.option('--resume/--restart', default=True, show_default=True, help='Continue an interrupted run from its checkpoint.')
+def verify_all_command(workers, page_size, writes_per_second, full, resume):
+    """Grade activities for every user (nightly re-grading)."""
+    def report(counts, elapsed):
+        # Rate from this invocation's work only; totals include resumed progress
+        rate = counts['run_processed'] / elapsed if elapsed else 0.0
+        click.echo(
+            f"{counts['processed']} user(s), {counts['activities']} activities graded, "
+            f"{counts['failed']} failed ({rate:.1f} users/s)"
+        )
+
+    result = verify_all_users(
+        workers=workers, page_size=page_size, resume=resume, full=full,
+        writes_per_second=writes_per_second, on_page=report
+    )
+    elapsed = result['elapsed_seconds']
+    click.echo(
+        f"Verified {result['processed']} user(s) in {elapsed}s: "
+        f"{result['activities']} activities graded "
+        f"({result['run_activities'] / elapsed if elapsed else 0:.1f}/s this run), {result['failed']} failed."
+    )
+
+
+def register_commands(app):
+    app.cli.add_command(sweep_proofs_command)
+    app.cli.add_command(generate_recommendations_command)
+    app.cli.add_command(sweep_expired_command)
+    app.cli.add_command(normalize_event_dates_command)
+    app.cli.add_command(export_grading_rules_command)
+    app.cli.add_command(verify_all_command)
+    app.cli.add_command(recompute_credits_command)
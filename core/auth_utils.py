@@ -3,7 +3,14 @@ Authentication utilities for CredPoint.
 Provides decorators and helpers for protecting routes.
 """
 
+import hashlib
+import os
+import threading
+import time
+from datetime import timedelta
 from functools import wraps
+
+from firebase_admin import auth
 from flask import redirect, url_for, g
 
 
@@ -25,3 +32,91 @@ def login_required(f):
             return redirect(url_for('routes.login_page'))
         return f(*args, **kwargs)
     return wrapper
+
+
+# =====================
+# Firebase session cookies
+# =====================
+# With FIREBASE_SESSION_COOKIES=True the login exchanges the one-hour ID token
+# for a Firebase session cookie (up to 14 days). Requests are authenticated by
+# verifying that cookie against Google's cached public keys plus a revocation
+# check, and verified cookies are remembered for a few minutes, so there is no
+# per-request token verification and no hourly token refresh round trip.
+# Logout revokes the user's refresh tokens; other workers drop the cookie
+# from their cache within VERIFIED_CACHE_SECONDS.
+#
+# Tradeoff: the revocation check is a Firebase Auth round trip (signature
+# checks alone are local). It runs on every cache miss, i.e. about once per
+# user per worker every VERIFIED_CACHE_SECONDS, which is the price of
+# logout/revocation taking effect everywhere within that window.
+SESSION_COOKIE_MODE = os.environ.get('FIREBASE_SESSION_COOKIES', 'False') == 'True'
+SESSION_COOKIE_NAME = '__session'  # the only cookie Firebase Hosting forwards
+SESSION_COOKIE_DAYS = min(int(os.environ.get('FIREBASE_SESSION_COOKIE_DAYS', '14')), 14)
+RECENT_SIGN_IN_SECONDS = 5 * 60
+VERIFIED_CACHE_SECONDS = 300
+MAX_VERIFIED_COOKIES = 10000
+
+_verified = {}  # sha256(cookie) -> (claims, cache_until)
+_verified_lock = threading.Lock()
+
+
+def _cookie_key(cookie):
+    return hashlib.sha256(cookie.encode()).hexdigest()
+
+
+def create_firebase_session_cookie(id_token):
+    """
+    Exchange a freshly issued ID token for a session cookie.
+    Returns (cookie, decoded_token, max_age_seconds); raises ValueError if the
+    sign-in is not recent, or the Firebase error if the token is invalid.
+    """
+    decoded = auth.verify_id_token(id_token)
+    if time.time() - decoded.get('auth_time', 0) > RECENT_SIGN_IN_SECONDS:
+        raise ValueError('Recent sign-in required')
+    expires_in = timedelta(days=SESSION_COOKIE_DAYS)
+    cookie = auth.create_session_cookie(id_token, expires_in=expires_in)
+    return cookie, decoded, int(expires_in.total_seconds())
+
+
+def verify_firebase_session_cookie(cookie):
+    """Return the cookie's claims, or None if it is missing, invalid or expired."""
+    if not cookie:
+        return None
+    key = _cookie_key(cookie)
+    now = time.time()
+    with _verified_lock:
+        cached = _verified.get(key)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    try:
+        claims = auth.verify_session_cookie(cookie, check_revoked=True)
+    except Exception:
+        return None
+
+    with _verified_lock:
+        if len(_verified) >= MAX_VERIFIED_COOKIES:
+            # Drop expired entries first, then the oldest ones
+            for stale in [k for k, (_, until) in _verified.items() if until <= now]:
+                del _verified[stale]
+            while len(_verified) >= MAX_VERIFIED_COOKIES:
+                _verified.pop(next(iter(_verified)))
+        _verified[key] = (claims, min(now + VERIFIED_CACHE_SECONDS, claims.get('exp', now)))
+    return claims
+
+
+def revoke_firebase_session_cookie(cookie):
+    """
+    Log a session cookie out: drop it from the verified cache and revoke the
+    user's refresh tokens, which invalidates every session cookie issued to
+    them. Best-effort; an invalid cookie needs no revoking.
+    """
+    if not cookie:
+        return
+    with _verified_lock:
+        _verified.pop(_cookie_key(cookie), None)
+    try:
+        claims = auth.verify_session_cookie(cookie)
+        auth.revoke_refresh_tokens(claims['sub'])
+    except Exception:
+        pass
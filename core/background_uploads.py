@@ -0,0 +1,71 @@
+"""
+Background proof uploads.
+
+With ASYNC_PROOF_UPLOADS=True the activity is saved straight away with
+proof_status 'uploading' and the validated file is handed to a small worker
+pool. When the transfer finishes the activity gets its proof_file and
+proof_status 'ready' (or 'failed'). The number of queued uploads is capped;
+when the pool is saturated callers fall back to uploading inline.
+
+Spooled files do not survive a worker restart, so uploads left 'uploading'
+by a dead worker are marked 'failed' by the sweep-proofs command.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from core.upload_pipeline import store_proof_file
+from core.image_derivatives import schedule_derivatives
+from services.models import set_activity_proof_status, set_activity_proof_derivatives, release_proof_blob
+
+logger = logging.getLogger(__name__)
+
+ASYNC_PROOF_UPLOADS = os.environ.get('ASYNC_PROOF_UPLOADS', 'False') == 'True'
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', '4'))
+MAX_PENDING_UPLOADS = int(os.environ.get('MAX_PENDING_UPLOADS', '32'))
+
+_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='uploads')
+# Counts queued + running uploads so spooled files cannot pile up without bound
+_slots = threading.BoundedSemaphore(MAX_PENDING_UPLOADS)
+
+
+def reserve_upload_slot():
+    """Return True if a background upload may be queued now."""
+    return _slots.acquire(blocking=False)
+
+
+def release_upload_slot():
+    _slots.release()
+
+
+def _upload_proof(uid, activity_id, spooled):
+    try:
+        proof_file = store_proof_file(uid, spooled)
+        if not set_activity_proof_status(uid, activity_id, 'ready', proof_file):
+            # Activity deleted mid-upload: drop the reference store_proof_file took
+            release_proof_blob(uid, proof_file)
+            return
+        schedule_derivatives(
+            proof_file, 'thumb',
+            on_complete=lambda paths: set_activity_proof_derivatives(uid, activity_id, proof_file, paths)
+        )
+    except Exception as e:
+        logger.error(f"Background proof upload failed for activity {activity_id}: {e}")
+        try:
+            set_activity_proof_status(uid, activity_id, 'failed')
+        except Exception:
+            pass
+    finally:
+        spooled.close()
+        _slots.release()
+
+
+def submit_proof_upload(uid, activity_id, spooled):
+    """
+    Upload a spooled proof file for an activity in the background.
+    The caller must hold a slot from reserve_upload_slot(); it is released
+    (and the spooled file closed) when the upload finishes.
+    """
+    return _executor.submit(_upload_proof, uid, activity_id, spooled)
@@ -0,0 +1,119 @@
+"""
+iCalendar (RFC 5545) feed of upcoming events for calendar subscriptions.
+
+Calendar apps poll a subscribed feed every few minutes, so the upcoming
+events are loaded once per (events version, day) and each authority's .ics
+body is rendered from them once and kept in memory; polls in between are
+served from that artifact, or answered with 304 by the ETag check before any
+events are read. Callers validate the authority, so the cache holds at most
+one body per known authority.
+"""
+
+import threading
+from datetime import datetime, time, timedelta, timezone
+
+PRODID = '-//CredPoint//Cybersecurity Events//EN'
+MAX_FEED_EVENTS = 500
+
+_feeds = {'key': None, 'events': None, 'bodies': {}}  # bodies: authority (or None) -> .ics
+_feeds_lock = threading.Lock()
+
+
+def _escape(text):
+    return (str(text or '').replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _fold(line):
+    """Fold a content line at 75 octets, as RFC 5545 requires."""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line
+    parts, start, width = [], 0, 75
+    while start < len(encoded):
+        end = min(start + width, len(encoded))
+        # Do not split inside a multi-byte UTF-8 sequence
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode('utf-8'))
+        start, width = end, 74  # continuation lines start with a space
+    return '\r\n '.join(parts)
+
+
+def _utc_stamp(value):
+    """Format a datetime as UTC; naive values are already UTC in this app."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.strftime('%Y%m%dT%H%M%SZ')
+
+
+def _event_lines(event, dtstamp):
+    start = event['date']
+    lines = ['BEGIN:VEVENT', f"UID:{event['id']}@credpoint", f'DTSTAMP:{dtstamp}']
+    if start.time() == time.min:
+        # Dates entered without a time are all-day events
+        lines.append(f"DTSTART;VALUE=DATE:{start.strftime('%Y%m%d')}")
+        lines.append(f"DTEND;VALUE=DATE:{(start + timedelta(days=1)).strftime('%Y%m%d')}")
+    else:
+        lines.append(f'DTSTART:{_utc_stamp(start)}')
+        lines.append('DURATION:PT1H')
+    lines.append(f"SUMMARY:{_escape(event.get('title'))}")
+    if event.get('description'):
+        lines.append(f"DESCRIPTION:{_escape(event['description'])}")
+    if event.get('location'):
+        lines.append(f"LOCATION:{_escape(event['location'])}")
+    if event.get('link'):
+        lines.append(f"URL:{_escape(event['link'])}")
+    lines.append('END:VEVENT')
+    return lines
+
+
+def build_ics(events, name='CredPoint Events'):
+    """Render events (dicts with id, title, date, ...) as an iCalendar document."""
+    dtstamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    lines = [
+        'BEGIN:VCALENDAR', 'VERSION:2.0', f'PRODID:{PRODID}', 'CALSCALE:GREGORIAN',
+        f'X-WR-CALNAME:{_escape(name)}', 'REFRESH-INTERVAL;VALUE=DURATION:PT1H',
+    ]
+    for event in events:
+        if isinstance(event.get('date'), datetime):
+            lines.extend(_event_lines(event, dtstamp))
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_fold(line) for line in lines) + '\r\n'
+
+
+def matches_authority(event, authority):
+    """True if the event is tagged for the authority (authority_tags or tags)."""
+    wanted = authority.lower()
+    tags = (event.get('authority_tags') or []) + (event.get('tags') or [])
+    return any(str(tag).lower() == wanted for tag in tags)
+
+
+def get_calendar_feed(authority, version, load_events):
+    """
+    Return the .ics body for an authority (None = all events); the authority
+    must already be validated against the known set.
+    `load_events()` returns the upcoming events and is only called when the
+    events version or the day changed since they were last loaded; every
+    authority's feed is filtered from that one list in memory.
+    Without a version the feed is built fresh and not cached.
+    """
+    key = (version, datetime.utcnow().date())
+    with _feeds_lock:
+        current = version is not None and _feeds['key'] == key
+        if current and authority in _feeds['bodies']:
+            return _feeds['bodies'][authority]
+        events = _feeds['events'] if current else None
+
+    if events is None:
+        events = load_events()
+    selected = [e for e in events if matches_authority(e, authority)] if authority else events
+    name = f'CredPoint Events - {authority}' if authority else 'CredPoint Events'
+    body = build_ics(selected[:MAX_FEED_EVENTS], name)
+
+    if version is not None:
+        with _feeds_lock:
+            if _feeds['key'] != key:
+                _feeds.update(key=key, events=events, bodies={})
+            _feeds['bodies'][authority] = body
+    return body
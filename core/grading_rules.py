@@ -0,0 +1,131 @@
+"""
+Declarative CPE grading rules.
+
+The rule table below is the single source of truth for auto-grading. Python
+compiles it into a dispatch map keyed by activity type; the n8n auto-grade
+workflow loads the same table as JSON (GET /api/grading-rules, or the
+exported n8n/grading_rules.json) and evaluates it with an equivalent
+interpreter. Change a rule here and both paths pick it up.
+
+Rule kinds:
+  per_hour        1 CPE per duration hour, optionally capped
+  fixed_evidence  fixed CPEs when a proof file / evidence is attached
+  fixed_flag      fixed CPEs when a boolean field on the activity is set
+  user_provided   the activity's own cpe_points, when evidence is attached
+
+Reasons are templates filled with {type} and {cpe}.
+"""
+
+import json
+
+# Lightweight grading rules based on OffSec handbook (simplified):
+# - course: 1 CPE per hour, cap 40 for typical course mapping
+# - webinar/conference: 1 CPE per hour
+# - public_speaking / published_paper: fixed 4 CPEs per event/paper
+# - lab_submission: 20 CPEs if accepted (external acceptance required)
+GRADING_RULES = {
+    'version': 1,
+    'rules': [
+        {'types': ['course'], 'kind': 'per_hour', 'cap': 40,
+         'reason': '{type}_{cpe}_hours', 'missing_reason': '{type}_missing_duration'},
+        {'types': ['webinar', 'conference'], 'kind': 'per_hour',
+         'reason': '{type}_{cpe}_hours', 'missing_reason': '{type}_missing_duration'},
+        {'types': ['public_speaking', 'published_paper'], 'kind': 'fixed_evidence', 'cpe': 4.0,
+         'reason': '{type}_standard', 'missing_reason': '{type}_no_evidence'},
+        {'types': ['lab_submission'], 'kind': 'fixed_flag', 'flag': 'accepted', 'cpe': 20.0,
+         'reason': '{type}_accepted', 'missing_reason': '{type}_pending_acceptance'},
+    ],
+    # Any other type: accept the user's cpe_points when evidence exists
+    'default': {'kind': 'user_provided',
+                'reason': 'user_provided_with_evidence', 'missing_reason': 'user_provided_no_evidence'},
+    'ungradable_reason': 'unable_to_grade',
+}
+
+
+def _has_evidence(activity):
+    return bool(activity.get('proof_file') or activity.get('evidence_paths'))
+
+
+def _approve(rule, atype, cpe):
+    return cpe, rule['reason'].format(type=atype, cpe=cpe), True
+
+
+def _hold(rule, atype):
+    return None, rule['missing_reason'].format(type=atype, cpe=''), False
+
+
+def _per_hour(rule, atype, activity):
+    duration = activity.get('duration_hours')
+    if not duration:
+        return _hold(rule, atype)
+    awarded = float(duration)
+    if rule.get('cap') is not None:
+        awarded = min(awarded, float(rule['cap']))
+    return _approve(rule, atype, awarded)
+
+
+def _fixed_evidence(rule, atype, activity):
+    if _has_evidence(activity):
+        return _approve(rule, atype, float(rule['cpe']))
+    return _hold(rule, atype)
+
+
+def _fixed_flag(rule, atype, activity):
+    if activity.get(rule['flag']):
+        return _approve(rule, atype, float(rule['cpe']))
+    return _hold(rule, atype)
+
+
+def _user_provided(rule, atype, activity):
+    if activity.get('cpe_points') is None:
+        return None, GRADING_RULES['ungradable_reason'], False
+    if _has_evidence(activity):
+        return _approve(rule, atype, float(activity['cpe_points']))
+    return _hold(rule, atype)
+
+
+RULE_KINDS = {
+    'per_hour': _per_hour,
+    'fixed_evidence': _fixed_evidence,
+    'fixed_flag': _fixed_flag,
+    'user_provided': _user_provided,
+}
+
+
+def compile_rules(table):
+    """
+    Compile a rule table into (dispatch, default): dispatch maps an activity
+    type to a grader(atype, activity) -> (awarded_cpe, reason, auto_approved).
+    """
+    def bind(rule):
+        handler = RULE_KINDS[rule['kind']]
+        return lambda atype, activity: handler(rule, atype, activity)
+
+    dispatch = {}
+    for rule in table['rules']:
+        grader = bind(rule)
+        for atype in rule['types']:
+            dispatch[atype] = grader
+    return dispatch, bind(table['default'])
+
+
+_dispatch, _default = compile_rules(GRADING_RULES)
+
+
+def grade(activity):
+    """Return (awarded_cpe or None, reason, auto_approved) for one activity."""
+    # If already awarded, return existing
+    if activity.get('awarded_cpe') is not None:
+        return activity.get('awarded_cpe'), 'already_awarded', True
+    atype = (activity.get('activity_type') or '').lower()
+    return _dispatch.get(atype, _default)(atype, activity)
+
+
+def grade_many(activities):
+    """Grade a sequence of activities; results are in the same order."""
+    return [grade(activity) for activity in activities]
+
+
+def export_rules_json(indent=2):
+    """The rule table as JSON, for the n8n auto-grade workflow."""
+    return json.dumps(GRADING_RULES, indent=indent)
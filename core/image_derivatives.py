@@ -0,0 +1,120 @@
+"""
+Derived thumbnails for profile images and proof files.
+
+Originals can be up to 10 MB; pages only need small previews. After an
+upload, a background job renders resized WebP (plus JPEG fallback) copies and
+stores them next to the original, e.g.
+
+    proofs/{uid}/sha256/{hash}.pdf  ->  proofs/{uid}/sha256/{hash}.thumb.webp
+
+Templates link to the derivative and fall back to the original until it exists.
+Only images are previewed; PDF proofs keep the plain link.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+from firebase_admin import storage
+
+logger = logging.getLogger(__name__)
+
+# variant -> longest edge in pixels
+DERIVATIVE_SIZES = {
+    'thumb': 320,
+    'avatar': 256,
+}
+DERIVATIVE_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+
+# Small, bounded pool: derivatives are best-effort and must not starve requests
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='derivatives')
+
+
+def derivative_path(blob_name, variant, fmt='webp'):
+    """Return the storage path of a derivative stored next to the original."""
+    base = blob_name.rsplit('.', 1)[0]
+    return f"{base}.{variant}.{fmt}"
+
+
+def _load_image(data, content_type, size):
+    if not (content_type or '').startswith('image/'):
+        return None
+
+    image = Image.open(BytesIO(data))
+    # Let the JPEG decoder downscale while decoding instead of after
+    image.draft('RGB', (size, size))
+    # Respect camera orientation before dropping EXIF metadata
+    return ImageOps.exif_transpose(image)
+
+
+def render_derivatives(data, content_type, variant):
+    """
+    Render the resized copies of an original file.
+    Returns {fmt: bytes}, or {} when the content cannot be previewed.
+    """
+    size = DERIVATIVE_SIZES[variant]
+    image = _load_image(data, content_type, size)
+    if image is None:
+        return {}
+
+    image.thumbnail((size, size))
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # JPEG has no alpha channel; flatten onto white
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    rendered = {}
+    for fmt, (pil_format, _) in DERIVATIVE_FORMATS.items():
+        out = BytesIO()
+        image.save(out, format=pil_format, quality=80, optimize=True)
+        rendered[fmt] = out.getvalue()
+    return rendered
+
+
+def generate_derivatives(blob_name, variant):
+    """
+    Build and upload the derivatives for a stored file.
+    Returns {fmt: derivative blob name}; existing derivatives are reused,
+    which keeps shared (deduplicated) proofs from being rendered twice.
+    """
+    bucket = storage.bucket()
+    paths = {fmt: derivative_path(blob_name, variant, fmt) for fmt in DERIVATIVE_FORMATS}
+    if all(bucket.blob(path).exists() for path in paths.values()):
+        return paths
+
+    original = bucket.get_blob(blob_name)
+    if original is None or not (original.content_type or '').startswith('image/'):
+        # Gone, or not previewable (PDF): skip the download
+        return {}
+
+    rendered = render_derivatives(original.download_as_bytes(), original.content_type, variant)
+    for fmt, payload in rendered.items():
+        bucket.blob(paths[fmt]).upload_from_string(payload, content_type=DERIVATIVE_FORMATS[fmt][1])
+    return {fmt: paths[fmt] for fmt in rendered}
+
+
+def _run(blob_name, variant, on_complete):
+    try:
+        paths = generate_derivatives(blob_name, variant)
+        if paths and on_complete:
+            on_complete(paths)
+    except Exception as e:
+        logger.error(f"Derivative generation failed for {blob_name}: {e}")
+
+
+def schedule_derivatives(blob_name, variant, on_complete=None):
+    """
+    Queue derivative generation in the background.
+    on_complete(paths) is called with {fmt: blob name} once they are stored.
+    """
+    if not blob_name:
+        return None
+    return _executor.submit(_run, blob_name, variant, on_complete)
@@ -0,0 +1,200 @@
+"""
+SQLite storage for Flask-Limiter, shared by every worker on one host.
+
+With storage_uri='memory://' each gunicorn worker counts on its own, so a
+limit of 5 per 15 minutes really allows 5 per worker and the effective limit
+depends on which worker a request lands on. This backend keeps the counters
+in one SQLite file (on /dev/shm when available, so it never touches disk)
+that all workers open in WAL mode; no outside service is needed.
+
+Counter updates are group-committed: concurrent hits in a process queue up
+while a write is in flight and the next writer applies the whole queue in
+one transaction. Every hit still gets its exact count back, so limits are
+not loosened; only the number of SQLite write transactions shrinks.
+Expired counters are purged in bulk at most once per PURGE_INTERVAL.
+
+Enable with RATE_LIMIT_STORAGE=sqlite:// (default path) or
+sqlite:///path/to/ratelimits.db. The default file name carries
+RATE_LIMIT_INSTANCE (else a hash of the app directory), so deployments that
+share a host, e.g. staging and production, never share counters. Only the
+fixed-window strategy is supported; check_strategy() rejects others at startup.
+"""
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from limits.storage import Storage
+
+DEFAULT_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+INSTANCE = os.environ.get('RATE_LIMIT_INSTANCE') or hashlib.sha1(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))).encode()
+).hexdigest()[:12]
+DEFAULT_PATH = os.path.join(DEFAULT_DIR, f'credpoint-{INSTANCE}-ratelimits.db')
+SUPPORTED_STRATEGIES = ('fixed-window',)
+PURGE_INTERVAL = 60  # seconds between bulk deletes of expired counters
+BUSY_TIMEOUT_MS = 5000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID
+"""
+
+# Start a new window when the stored one has expired, otherwise add to it
+_UPSERT = """
+INSERT INTO counters (key, value, expires_at) VALUES (:key, :amount, :expires_at)
+ON CONFLICT(key) DO UPDATE SET
+    value = CASE WHEN counters.expires_at <= :now THEN excluded.value
+                 ELSE counters.value + excluded.value END,
+    expires_at = CASE WHEN counters.expires_at <= :now OR :elastic THEN excluded.expires_at
+                      ELSE counters.expires_at END
+RETURNING value
+"""
+
+
+def storage_path(uri):
+    """Database path for a sqlite:// URI ('sqlite://' alone = DEFAULT_PATH)."""
+    path = uri.split('://', 1)[1].split('?', 1)[0] if '://' in uri else ''
+    return path or DEFAULT_PATH
+
+
+def check_strategy(storage_uri, strategy):
+    """Raise ValueError at startup if the sqlite:// storage cannot run `strategy`."""
+    if storage_uri.startswith('sqlite:') and (strategy or 'fixed-window') not in SUPPORTED_STRATEGIES:
+        raise ValueError(
+            f"RATELIMIT_STRATEGY={strategy} is not supported by sqlite:// rate-limit storage "
+            f"(supported: {', '.join(SUPPORTED_STRATEGIES)})"
+        )
+
+
+class _Increment:
+    __slots__ = ('key', 'expiry', 'elastic', 'amount', 'result', 'error', 'done')
+
+    def __init__(self, key, expiry, elastic, amount):
+        self.key, self.expiry, self.elastic, self.amount = key, expiry, elastic, amount
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SQLiteStorage(Storage):
+    """limits storage backend keeping fixed-window counters in a shared SQLite file."""
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri='sqlite://', wrap_exceptions=False, **options):
+        self.path = storage_path(uri)
+        self._lock = threading.RLock()  # guards the connection
+        self._queue_lock = threading.Lock()
+        self._queue = []
+        self._flushing = False
+        self._conn = None
+        self._pid = None
+        self._purged_at = 0.0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    # ---- connection ----
+    def _connection(self):
+        # One connection per process: forked workers must not share the parent's
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000,
+                                   isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(_SCHEMA)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    # ---- writes (group commit) ----
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        """Add `amount` to the key's current window and return the new count."""
+        op = _Increment(key, expiry, elastic_expiry, amount)
+        with self._queue_lock:
+            self._queue.append(op)
+            leader = not self._flushing
+            self._flushing = True
+        if leader:
+            self._drain()
+        else:
+            op.done.wait()
+        if op.error is not None:
+            raise op.error
+        return op.result
+
+    def _drain(self):
+        """Apply queued increments, one transaction per batch, until the queue is empty."""
+        while True:
+            with self._queue_lock:
+                batch, self._queue = self._queue, []
+                if not batch:
+                    self._flushing = False
+                    return
+            try:
+                self._apply(batch)
+            except Exception as e:
+                for op in batch:
+                    op.error = e
+            finally:
+                for op in batch:
+                    op.done.set()
+
+    def _apply(self, batch):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for op in batch:
+                    op.result = conn.execute(_UPSERT, {
+                        'key': op.key, 'amount': op.amount, 'expires_at': now + op.expiry,
+                        'now': now, 'elastic': bool(op.elastic)
+                    }).fetchone()[0]
+                if now - self._purged_at >= PURGE_INTERVAL:
+                    conn.execute('DELETE FROM counters WHERE expires_at <= ?', (now,))
+                    self._purged_at = now
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    # ---- reads ----
+    def get(self, key):
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT value FROM counters WHERE key = ? AND expires_at > ?', (key, time.time())
+            ).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT expires_at FROM counters WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+        return row[0] if row else now
+
+    def check(self):
+        try:
+            with self._lock:
+                self._connection().execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        with self._lock:
+            return self._connection().execute('DELETE FROM counters').rowcount
+
+    def clear(self, key):
+        with self._lock:
+            self._connection().execute('DELETE FROM counters WHERE key = ?', (key,))
@@ -1,17 +1,172 @@
-from services.models import get_user_activities, create_recommendation
+from services.models import (
+    get_user, get_user_activities, create_recommendation, iter_user_pages,
+    claim_job_checkpoint, commit_job_checkpoint, JOB_LEASE_SECONDS
+)
 from datetime import datetime
 from services.firebase_config import db
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import threading
+import time
+import uuid
 import requests
 import os
 import logging
 
+# =====================
+# n8n RESULT CACHE (stale-while-revalidate + circuit breaker)
+# =====================
+# Results are cached per (cert_name, authority). Fresh entries are served
+# directly; stale ones are served immediately while one background refresh
+# runs. After repeated failures n8n is not called at all until the cooldown
+# has passed, so a slow or down instance never sits on the request path.
+# The cache is an LRU capped at N8N_CACHE_MAX_ENTRIES keys.
+N8N_CACHE_TTL = int(os.environ.get('N8N_CACHE_TTL', '900'))  # seconds
+N8N_CACHE_MAX_ENTRIES = 1024
+N8N_TIMEOUT = 4
+N8N_FAILURE_THRESHOLD = 3
+N8N_COOLDOWN = 60  # seconds the circuit stays open
+
+_n8n_cache = OrderedDict()  # key -> (fetched_at, recommendations), least recently used first
+_n8n_refreshing = set()     # keys with a background refresh in flight
+_n8n_circuit = {'failures': 0, 'opened_at': None, 'trial': False}
+_n8n_lock = threading.Lock()
+_n8n_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='n8n-refresh')
+
+
+def _n8n_circuit_allows_call():
+    with _n8n_lock:
+        opened_at = _n8n_circuit['opened_at']
+        if opened_at is None:
+            return True
+        if time.monotonic() - opened_at >= N8N_COOLDOWN and not _n8n_circuit['trial']:
+            # Half-open: exactly one trial call goes through; everyone else
+            # keeps skipping n8n until it reports back
+            _n8n_circuit['trial'] = True
+            return True
+        return False
+
+
+def _record_n8n_result(ok):
+    with _n8n_lock:
+        _n8n_circuit['trial'] = False
+        if ok:
+            _n8n_circuit['failures'] = 0
+            _n8n_circuit['opened_at'] = None
+        else:
+            _n8n_circuit['failures'] += 1
+            if _n8n_circuit['failures'] >= N8N_FAILURE_THRESHOLD:
+                # Also restarts the cooldown after a failed trial call
+                _n8n_circuit['opened_at'] = time.monotonic()
+
+
+def _call_n8n(n8n_url, cert_name, cert_authority, uid):
+    """POST to the n8n webhook and normalize the response into a list of dicts."""
+    payload = {"cert_name": cert_name, "authority": cert_authority, "uid": uid}
+    response = requests.post(n8n_url, json=payload, timeout=N8N_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()
+
+    # Enterprise Data Normalization: Handle various n8n response formats
+    raw_list = []
+    if isinstance(data, list):
+        raw_list = data
+    elif isinstance(data, dict):
+        # Check common keys used in n8n or API wrappers
+        raw_list = data.get('recommendations') or data.get('data') or data.get('items') or [data]
+
+    # Filter out non-dict items
+    if not isinstance(raw_list, list):
+        return []
+    return [r for r in raw_list if isinstance(r, dict)]
+
+
+def _refresh_n8n(n8n_url, key, uid):
+    """Fetch from n8n and update the cache; returns the list or None on failure."""
+    logger = logging.getLogger(__name__)
+    if not _n8n_circuit_allows_call():
+        return None
+    try:
+        recs = _call_n8n(n8n_url, key[0], key[1], uid)
+    except Exception as e:
+        logger.error(f"n8n recommendation fetch failed: {e}")
+        _record_n8n_result(False)
+        return None
+    _record_n8n_result(True)
+    with _n8n_lock:
+        _n8n_cache[key] = (time.monotonic(), recs)
+        _n8n_cache.move_to_end(key)
+        while len(_n8n_cache) > N8N_CACHE_MAX_ENTRIES:
+            _n8n_cache.popitem(last=False)
+    return recs
+
+
+def _background_refresh(n8n_url, key, uid):
+    try:
+        _refresh_n8n(n8n_url, key, uid)
+    finally:
+        with _n8n_lock:
+            _n8n_refreshing.discard(key)
+
+
+def fetch_n8n_recommendations(n8n_url, cert_name, cert_authority, uid=None, force_refresh=False):
+    """
+    Return n8n recommendations for a certification through the cache.
+    Only a cold (or forced) lookup waits on n8n; stale entries trigger a
+    single background refresh and are returned as-is.
+    """
+    key = (cert_name, cert_authority)
+    with _n8n_lock:
+        cached = _n8n_cache.get(key)
+        if cached is not None:
+            _n8n_cache.move_to_end(key)
+
+    if cached is None or force_refresh:
+        recs = _refresh_n8n(n8n_url, key, uid)
+        if recs is not None:
+            return list(recs)
+        return list(cached[1]) if cached else []
+
+    fetched_at, recs = cached
+    if time.monotonic() - fetched_at >= N8N_CACHE_TTL:
+        with _n8n_lock:
+            start = key not in _n8n_refreshing
+            if start:
+                _n8n_refreshing.add(key)
+        if start:
+            _n8n_executor.submit(_background_refresh, n8n_url, key, uid)
+    return list(recs)
+
+BATCH_LIMIT = 500  # Firestore maximum writes per batch
+
+
+def recommendation_doc_id(rec):
+    """Deterministic document ID so re-running generation overwrites instead of duplicating."""
+    key = rec.get("url") or rec.get("title") or repr(sorted(rec.items()))
+    return hashlib.sha256(str(key).encode("utf-8")).hexdigest()[:32]
+
+
+def store_user_recommendations(rec_ref, recommendations):
+    """Write recommendations into a user's subcollection with batched, idempotent sets."""
+    now = datetime.utcnow()
+    by_id = {recommendation_doc_id(rec): rec for rec in recommendations}
+    items = list(by_id.items())
+    for start in range(0, len(items), BATCH_LIMIT):
+        batch = db.batch()
+        for doc_id, rec in items[start:start + BATCH_LIMIT]:
+            batch.set(rec_ref.document(doc_id), {**rec, "created_at": now})
+        batch.commit()
+
+
 # =====================
 # RECOMMENDATION LOGIC
 # =====================
-def generate_recommendations(cert_name, cert_authority, uid=None):
+def generate_recommendations(cert_name, cert_authority, uid=None, force_refresh=False):
     """
     Fetches recommendations from Firestore 'global_recommendations' collection
     based on matching tags or authority.
+    force_refresh bypasses the n8n result cache.
     """
     logger = logging.getLogger(__name__)
     recommendations = []
@@ -19,30 +174,13 @@ def generate_recommendations(cert_name, cert_authority, uid=None):
     cert_name = cert_name.lower() if cert_name else ""
     cert_authority = cert_authority.lower() if cert_authority else ""
 
-    # 1. n8n Integration: Fetch Real-Time Data
+    # 1. n8n Integration: Fetch Real-Time Data (cached, see above)
     # Set N8N_WEBHOOK_URL in your environment variables
     n8n_url = os.environ.get('N8N_WEBHOOK_URL')
     if n8n_url:
-        try:
-            payload = {"cert_name": cert_name, "authority": cert_authority, "uid": uid}
-            response = requests.post(n8n_url, json=payload, timeout=4)
-            if response.status_code == 200:
-                data = response.json()
-                
-                # Enterprise Data Normalization: Handle various n8n response formats
-                raw_list = []
-                if isinstance(data, list):
-                    raw_list = data
-                elif isinstance(data, dict):
-                    # Check common keys used in n8n or API wrappers
-                    raw_list = data.get('recommendations') or data.get('data') or data.get('items') or [data]
-                
-                # Filter out non-dict items and append
-                if isinstance(raw_list, list):
-                    valid_recs = [r for r in raw_list if isinstance(r, dict)]
-                    recommendations.extend(valid_recs)
-        except Exception as e:
-            logger.error(f"n8n recommendation fetch failed: {e}")
+        recommendations.extend(
+            fetch_n8n_recommendations(n8n_url, cert_name, cert_authority, uid, force_refresh=force_refresh)
+        )
 
     # 2. Fallback: Firestore & Static Criteria
     # Enterprise Approach: Query a curated collection in DB
@@ -93,8 +231,163 @@ def generate_recommendations(cert_name, cert_authority, uid=None):
     # Store in Firestore only if uid is provided and no previous recommendations exist
     if uid:
         rec_ref = db.collection("users").document(uid).collection("recommendations")
-        if not list(rec_ref.stream()):
-            for rec in recommendations:
-                rec_ref.add({**rec, "created_at": datetime.utcnow()})
+        # Existence probe reads at most one document
+        if not list(rec_ref.limit(1).stream()):
+            store_user_recommendations(rec_ref, recommendations)
+
+    return recommendations
 
-    return recommendations
\ No newline at end of file
+
+# =====================
+# BULK GENERATION (daily job)
+# =====================
+def _generate_for_user(user):
+    try:
+        recs = generate_recommendations(None, None, user["uid"])
+        return user, len(recs or []), None
+    except Exception as e:
+        return user, 0, e
+
+
+class JobBusy(RuntimeError):
+    """Another run holds the job's checkpoint lease."""
+
+
+def _generate_page(pool, users, counts, failed_uids, collect_users, retry=False):
+    """
+    Generate for a batch of users, updating counts and failed_uids in place;
+    returns the users notified. With retry=True the users are earlier
+    failures: successes leave failed_uids and are not counted as processed again.
+    """
+    logger = logging.getLogger(__name__)
+    users_with_recs = []
+    for user, rec_count, error in pool.map(_generate_for_user, users):
+        if not retry:
+            counts["processed"] += 1
+        if error:
+            logger.error(f"Recommendation generation failed for {user['uid']}: {error}")
+            if user["uid"] not in failed_uids:
+                failed_uids.append(user["uid"])
+            continue
+        if retry:
+            failed_uids.remove(user["uid"])
+        counts["recommendations"] += rec_count
+        if rec_count:
+            counts["with_recommendations"] += 1
+            if collect_users:
+                users_with_recs.append({
+                    "uid": user["uid"],
+                    "name": user.get("full_name") or user.get("name") or user.get("email"),
+                    "email": user.get("email")
+                })
+    counts["failed"] = len(failed_uids)
+    return users_with_recs
+
+
+def _run_page(pool, job_name, owner, page_size, restart, collect_users, release, lease_seconds):
+    """
+    Claim the job's checkpoint, process its next page and commit the
+    progress under the same lease. Users that fail stay in failed_uids; once
+    the last page is done they are retried once, page_size at a time
+    (retry_uids), before the run completes. Raises JobBusy if another run
+    holds the lease, or took it over before this page was committed.
+    Returns (counts, done, page_users, users).
+    """
+    state = claim_job_checkpoint(job_name, owner, lease_seconds, restart)
+    if state is None:
+        raise JobBusy(f"Job {job_name} is being run by another process")
+
+    try:
+        return _process_claimed(pool, job_name, owner, state, page_size, collect_users, release)
+    except JobBusy:
+        raise
+    except Exception:
+        # Let the next call retry this page instead of waiting out the lease
+        try:
+            commit_job_checkpoint(job_name, owner, {}, release=True)
+        except Exception:
+            pass
+        raise
+
+
+def _process_claimed(pool, job_name, owner, state, page_size, collect_users, release):
+    """One page (or retry batch) of a claimed run; see _run_page."""
+    counts = dict(state.get("counts") or {})
+    for key in ("processed", "with_recommendations", "recommendations", "failed"):
+        counts.setdefault(key, 0)
+    failed_uids = list(state.get("failed_uids") or [])
+    retry_uids = state.get("retry_uids")
+
+    if retry_uids is None:
+        page = next(iter_user_pages(page_size, state.get("last_uid")), [])
+        users = _generate_page(pool, page, counts, failed_uids, collect_users)
+        update = {"counts": counts, "failed_uids": failed_uids}
+        if page:
+            update["last_uid"] = page[-1]["uid"]
+        if len(page) < page_size:
+            # Every page is done; retry this run's failures once
+            update["retry_uids"] = list(failed_uids)
+    else:
+        batch = [{**(get_user(uid) or {}), "uid": uid} for uid in retry_uids[:page_size]]
+        users = _generate_page(pool, batch, counts, failed_uids, collect_users, retry=True)
+        update = {"counts": counts, "failed_uids": failed_uids, "retry_uids": retry_uids[page_size:]}
+        page = batch
+
+    done = update.get("retry_uids") == []
+    if done:
+        update["status"] = "completed"
+    if not commit_job_checkpoint(job_name, owner, update, release=release or done):
+        raise JobBusy(f"Job {job_name} lease was taken over by another process")
+    return counts, done, len(page), users
+
+
+def generate_recommendations_page(workers=8, page_size=50, resume=True,
+                                  job_name="daily_recommendations", collect_users=False,
+                                  lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Process the next page of a paged run and return.
+
+    The HTTP job endpoint calls this once per request so no request outlives
+    the worker timeout; the caller repeats until `done`. Each call holds the
+    checkpoint's lease while it works, so overlapping callers get JobBusy
+    instead of processing the same page. Counts are the run's totals from
+    the checkpoint, so they cover pages processed by earlier (or
+    interrupted) calls. `users` lists only this call's users that received
+    recommendations, so callers notify them as each page completes.
+    resume=False starts a new run.
+    """
+    owner = uuid.uuid4().hex
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="recs-bulk") as pool:
+        counts, done, page_users, users = _run_page(
+            pool, job_name, owner, page_size, not resume, collect_users, True, lease_seconds
+        )
+    result = {**counts, "done": done, "page_users": page_users}
+    if collect_users:
+        result["users"] = users
+    return result
+
+
+def generate_recommendations_for_all_users(workers=8, page_size=200, resume=True,
+                                           job_name="daily_recommendations",
+                                           lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Generate recommendations for every user with a bounded thread pool.
+
+    Users are paged by document id and progress is checkpointed in
+    jobs/{job_name} after every page under this run's lease (renewed per
+    page), so an interrupted run resumes after the last completed page and
+    a concurrent run raises JobBusy. Failed users are retried once at the
+    end. Returns aggregate counts for the whole run.
+    """
+    owner = uuid.uuid4().hex
+    started = time.monotonic()
+    restart = not resume
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="recs-bulk") as pool:
+        while True:
+            counts, done, _, _ = _run_page(
+                pool, job_name, owner, page_size, restart, False, False, lease_seconds
+            )
+            restart = False
+            if done:
+                break
+    return {**counts, "elapsed_seconds": round(time.monotonic() - started, 1)}
@@ -0,0 +1,175 @@
+"""
+Relevance ranking of approved recommendations for a user.
+
+Recommendations are scored by how much they close the user's real gaps:
+remaining CPEs per certification, the ISC2 Group A deficit, the ISACA
+annual shortfall and how close renewal is, weighed against the CPEs the
+item is expected to award and when it expires.
+
+Scoring only looks at candidates pulled from an inverted index keyed by
+(authority, activity type), and the top-K per user is cached. The cache key
+carries the user's `ranking_version` (bumped whenever their activities or
+certifications change) and the recommendation corpus version, so stale
+rankings are never served and no explicit cross-process invalidation is needed.
+
+A corpus version identifies one candidate set: when callers rank against
+per-user subsets of the corpus (e.g. filtered by authority), the subset must
+be part of the version. Inverted indexes are kept per version, a few at a time.
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+TOP_K = 50
+EXPIRY_SOON_DAYS = 14
+RENEWAL_URGENT_DAYS = 90
+MAX_CACHED_USERS = 5000
+MAX_CACHED_INDEXES = 16
+
+_cache = OrderedDict()  # uid -> ((ranking_version, corpus_version), ranked list)
+_cache_lock = threading.Lock()
+_index_lock = threading.Lock()
+_indexes = OrderedDict()  # corpus_version -> (postings, docs)
+
+
+def build_inverted_index(recommendations):
+    """Map (authority, activity_type) -> set of recommendation ids."""
+    postings = {}
+    for rec in recommendations:
+        activity_type = rec.get('activity_type') or ''
+        for authority in rec.get('authority_tags') or []:
+            postings.setdefault((authority, activity_type), set()).add(rec['id'])
+    return postings
+
+
+def _corpus_index(recommendations, corpus_version):
+    """Return (postings, docs) for the corpus, building it once per corpus version."""
+    with _index_lock:
+        cached = _indexes.get(corpus_version) if corpus_version is not None else None
+        if cached:
+            _indexes.move_to_end(corpus_version)
+            return cached
+
+    docs = {rec['id']: rec for rec in recommendations}
+    built = (build_inverted_index(docs.values()), docs)
+    if corpus_version is not None:
+        with _index_lock:
+            _indexes[corpus_version] = built
+            _indexes.move_to_end(corpus_version)
+            while len(_indexes) > MAX_CACHED_INDEXES:
+                _indexes.popitem(last=False)
+    return built
+
+
+def _as_naive(value):
+    """Naive UTC datetime from a datetime or ISO-8601 string (n8n stores strings)."""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        return value.replace(tzinfo=None)
+    return None
+
+
+def _authority_weight(gap):
+    """How much a user needs CPEs for one authority (0 = nothing outstanding)."""
+    required = gap.get('required') or 0
+    weight = (gap.get('remaining') or 0) / required if required else 0.0
+
+    if gap.get('group_a_required'):
+        weight += 0.5 * (gap.get('group_a_remaining') or 0) / gap['group_a_required']
+    if gap.get('annual_required'):
+        weight += 0.5 * (gap.get('annual_remaining') or 0) / gap['annual_required']
+
+    days_left = gap.get('days_to_renewal')
+    if days_left is not None and days_left <= RENEWAL_URGENT_DAYS and weight > 0:
+        weight += 0.5
+    return weight
+
+
+def score_recommendation(rec, gaps, now=None):
+    """Score one recommendation against per-authority gaps; 0 means not useful."""
+    now = now or datetime.utcnow()
+    expires_at = _as_naive(rec.get('expires_at'))
+    if expires_at and expires_at < now:
+        return 0.0
+
+    try:
+        min_cpe = float(rec.get('min_cpe') or rec.get('cpe') or 0)
+        max_cpe = float(rec.get('max_cpe') or min_cpe)
+    except (TypeError, ValueError):
+        min_cpe = max_cpe = 0.0
+    expected_cpe = (min_cpe + max_cpe) / 2
+
+    score = 0.0
+    for authority in rec.get('authority_tags') or []:
+        gap = gaps.get(authority)
+        if not gap:
+            continue
+        remaining = max(gap.get('group_a_remaining') or 0, gap.get('annual_remaining') or 0, gap.get('remaining') or 0)
+        # Fraction of the outstanding need this item would cover
+        coverage = min(expected_cpe, remaining) / remaining if remaining > 0 else 0.0
+        score += _authority_weight(gap) * (0.5 + coverage)
+
+    if score and expires_at and (expires_at - now).days <= EXPIRY_SOON_DAYS:
+        score *= 1.1  # act-now bonus for items that are about to lapse
+    return round(score, 4)
+
+
+def rank_recommendations(recommendations, gaps, allowed_types, k=TOP_K, corpus_version=None):
+    """
+    Return the top-k recommendations for the given gaps, highest score first.
+    `allowed_types` maps authority -> activity types it accepts; only
+    postings for those (authority, type) pairs are scored.
+    """
+    postings, docs = _corpus_index(recommendations, corpus_version)
+
+    candidates = set()
+    for authority in gaps:
+        types = allowed_types.get(authority)
+        if types is None:
+            # Unknown rules: any activity type tagged for this authority
+            for (tag, _), ids in postings.items():
+                if tag == authority:
+                    candidates |= ids
+            continue
+        for activity_type in types:
+            candidates |= postings.get((authority, activity_type), set())
+
+    now = datetime.utcnow()
+    scored = []
+    for rec_id in candidates:
+        rec = docs[rec_id]
+        score = score_recommendation(rec, gaps, now)
+        if score > 0:
+            scored.append((score, rec_id))
+    scored.sort(reverse=True)
+    return [{**docs[rec_id], 'relevance': score} for score, rec_id in scored[:k]]
+
+
+def get_ranked_recommendations(uid, ranking_version, corpus_version, load_inputs, k=TOP_K):
+    """
+    Cached top-k for a user. `load_inputs()` returns
+    (recommendations, gaps, allowed_types) and is only called on a miss.
+    """
+    key = (ranking_version, corpus_version)
+    with _cache_lock:
+        cached = _cache.get(uid)
+        if cached and cached[0] == key and corpus_version is not None:
+            _cache.move_to_end(uid)
+            return [dict(rec) for rec in cached[1]]
+
+    recommendations, gaps, allowed_types = load_inputs()
+    ranked = rank_recommendations(recommendations, gaps, allowed_types, k, corpus_version)
+
+    with _cache_lock:
+        _cache[uid] = (key, ranked)
+        _cache.move_to_end(uid)
+        while len(_cache) > MAX_CACHED_USERS:
+            _cache.popitem(last=False)
+    return [dict(rec) for rec in ranked]
@@ -0,0 +1,248 @@
+"""
+Single-pass upload pipeline for proof files and profile images.
+
+The uploaded stream is read once in fixed-size chunks. Each chunk is checked
+against the size cap, hashed, and (optionally) written straight into a
+resumable Cloud Storage upload, so memory use stays bounded by CHUNK_SIZE.
+The content type is taken from the file's magic bytes, not its extension.
+
+Proof files are content addressed: they are stored once per user under their
+SHA-256 and shared by every activity that attaches the same file.
+"""
+
+import hashlib
+import logging
+import tempfile
+
+from firebase_admin import storage
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from core.image_derivatives import DERIVATIVE_FORMATS, DERIVATIVE_SIZES, derivative_path
+from services.models import (
+    acquire_proof_blob, register_proof_blob,
+    get_orphaned_proof_blobs, claim_orphaned_proof_blob, delete_claimed_proof_blob
+)
+
+logger = logging.getLogger(__name__)
+
+# Resumable uploads require chunk sizes that are multiples of 256 KiB.
+CHUNK_SIZE = 4 * 256 * 1024  # 1 MiB
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10 MB
+
+# (signature, mime type, canonical extension)
+MAGIC_SIGNATURES = (
+    (b'%PDF-', 'application/pdf', 'pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png', 'png'),
+    (b'\xff\xd8\xff', 'image/jpeg', 'jpg'),
+)
+SNIFF_BYTES = max(len(sig) for sig, _, _ in MAGIC_SIGNATURES)
+
+
+class UploadRejected(ValueError):
+    """Raised when an upload fails size or content checks."""
+
+
+def sniff_content_type(head):
+    """Return (mime_type, extension) for the leading bytes, or (None, None)."""
+    for signature, mime_type, ext in MAGIC_SIGNATURES:
+        if head.startswith(signature):
+            return mime_type, ext
+    return None, None
+
+
+def _iter_checked_chunks(file_obj, result, max_size, chunk_size):
+    """
+    Yield chunks from file_obj while enforcing the size cap, sniffing the
+    content type from the first bytes and updating the SHA-256 digest.
+    Fills `result` in place as the stream is consumed.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    head = b''
+
+    while True:
+        chunk = file_obj.read(chunk_size)
+        if not chunk:
+            break
+
+        size += len(chunk)
+        if size > max_size:
+            raise UploadRejected(f'File too large (max {max_size / 1024 / 1024:.0f} MB)')
+
+        if result['content_type'] is None:
+            head += chunk[:SNIFF_BYTES - len(head)]
+            if len(head) >= SNIFF_BYTES:
+                mime_type, ext = sniff_content_type(head)
+                if not mime_type:
+                    raise UploadRejected('File content is not a PDF, PNG or JPEG')
+                result['content_type'] = mime_type
+                result['extension'] = ext
+
+        digest.update(chunk)
+        yield chunk
+
+    if size == 0:
+        raise UploadRejected('File is empty')
+
+    if result['content_type'] is None:
+        # Stream shorter than the longest signature
+        mime_type, ext = sniff_content_type(head)
+        if not mime_type:
+            raise UploadRejected('File content is not a PDF, PNG or JPEG')
+        result['content_type'] = mime_type
+        result['extension'] = ext
+
+    result['size'] = size
+    result['sha256'] = digest.hexdigest()
+
+
+def _new_result():
+    return {'size': 0, 'sha256': None, 'content_type': None, 'extension': None, 'blob_name': None}
+
+
+def scan_upload(file_obj, max_size=MAX_UPLOAD_SIZE, chunk_size=CHUNK_SIZE):
+    """
+    Validate and hash an upload without sending it anywhere.
+    Returns a dict with size, sha256, content_type and extension.
+    Raises UploadRejected if the file is empty, too large or of an unknown type.
+    """
+    result = _new_result()
+    for _ in _iter_checked_chunks(file_obj, result, max_size, chunk_size):
+        pass
+    return result
+
+
+def spool_upload(file_obj, max_size=MAX_UPLOAD_SIZE, chunk_size=CHUNK_SIZE):
+    """
+    Validate an upload while copying it to a temporary file that outlives the
+    request (the request stream is closed once the response is sent).
+    Returns (temp_file, result); the caller owns and must close temp_file.
+    """
+    result = _new_result()
+    spooled = tempfile.TemporaryFile()
+    try:
+        for chunk in _iter_checked_chunks(file_obj, result, max_size, chunk_size):
+            spooled.write(chunk)
+    except Exception:
+        spooled.close()
+        raise
+    spooled.seek(0)
+    return spooled, result
+
+
+def stream_upload(file_obj, blob_path, max_size=MAX_UPLOAD_SIZE, chunk_size=CHUNK_SIZE, bucket=None):
+    """
+    Validate, hash and upload a file to Cloud Storage in a single read.
+
+    The first chunk is sniffed before the resumable upload session is opened
+    so the blob gets the detected content type. If a later chunk breaks the
+    size cap, UploadRejected is raised; on that or any other failure the
+    writer is closed and the partial object removed.
+
+    Returns the same dict as scan_upload(), plus blob_name.
+    """
+    result = _new_result()
+    bucket = bucket or storage.bucket()
+    blob = bucket.blob(blob_path)
+    chunks = _iter_checked_chunks(file_obj, result, max_size, chunk_size)
+
+    first = next(chunks, None)
+    if first is None:
+        # Generator raises on empty input; this only guards odd file objects.
+        raise UploadRejected('File is empty')
+    if result['content_type'] is None:
+        # Short read below the sniff window; gather the rest (bounded by max_size)
+        first += b''.join(chunks)
+
+    writer = blob.open('wb', chunk_size=chunk_size, content_type=result['content_type'])
+    completed = False
+    try:
+        writer.write(first)
+        for chunk in chunks:
+            writer.write(chunk)
+        writer.close()
+        completed = True
+    finally:
+        if not completed:
+            # Any failure (size cap, read or network error): BlobWriter
+            # finalizes on close/garbage collection, so commit what was sent
+            # and remove it rather than leave a truncated object behind.
+            try:
+                if not writer.closed:
+                    writer.close()
+                blob.delete()
+            except Exception:
+                logger.warning('Could not remove partial upload %s', blob_path, exc_info=True)
+
+    result['blob_name'] = blob.name
+    result['generation'] = blob.generation
+    return result
+
+
+def store_proof_file(uid, file_obj):
+    """
+    Store a proof file under its content hash, reusing an existing blob when
+    the user has already uploaded identical content.
+
+    The local (spooled) request stream is hashed first; only content that is
+    not yet stored is streamed to Cloud Storage. Returns the blob name.
+    """
+    scanned = scan_upload(file_obj)
+    existing = acquire_proof_blob(uid, scanned['sha256'])
+    if existing:
+        return existing
+
+    file_obj.seek(0)
+    blob_path = f"proofs/{uid}/sha256/{scanned['sha256']}.{scanned['extension']}"
+    upload = stream_upload(file_obj, blob_path)
+    if upload.get('generation') is None:
+        # BlobWriter does not report object metadata; the sweep needs the generation
+        stored = storage.bucket().get_blob(blob_path)
+        upload['generation'] = stored.generation if stored else None
+    return register_proof_blob(uid, upload)
+
+
+def _delete_original(bucket, record):
+    """
+    Delete an orphaned original. Returns True when it is gone, False when it
+    must be kept (re-uploaded since the record was read) or the delete failed.
+    """
+    blob_name = record['blob_name']
+    try:
+        # The generation precondition keeps a blob re-uploaded after the claim
+        bucket.blob(blob_name).delete(if_generation_match=record.get('generation'))
+        return True
+    except NotFound:
+        return True
+    except PreconditionFailed:
+        logger.warning(f"Proof {blob_name} was re-uploaded during the sweep; keeping it")
+    except Exception as e:
+        logger.error(f"Failed to delete orphaned proof {blob_name}: {e}")
+    return False
+
+
+def sweep_orphaned_proofs(limit=500):
+    """
+    Delete proof blobs (and their derivatives) that no activity references
+    any more. The record is claimed first and only removed once the blob is
+    gone, so a failed delete is retried by the next sweep.
+    Returns the number of blobs removed.
+    """
+    bucket = storage.bucket()
+    removed = 0
+    for snapshot in get_orphaned_proof_blobs(limit):
+        record = snapshot.to_dict()
+        claimed_at = claim_orphaned_proof_blob(snapshot)
+        if claimed_at is None or not _delete_original(bucket, record):
+            continue
+
+        derivatives = [
+            bucket.blob(derivative_path(record['blob_name'], variant, fmt))
+            for variant in DERIVATIVE_SIZES for fmt in DERIVATIVE_FORMATS
+        ]
+        bucket.delete_blobs(
+            derivatives,
+            on_error=lambda blob: logger.debug(f"Derivative {blob.name} not deleted (missing?)")
+        )
+        delete_claimed_proof_blob(snapshot.reference, claimed_at)
+        removed += 1
+    return removed
@@ -173,6 +173,11 @@ def normalize_activity(act):
     # Secure URL generation
     act['proof_file_url'] = get_secure_file_url(proof_file_name)
 
+    # Thumbnails rendered in the background; absent until they are ready
+    derivatives = act.get('proof_derivatives') or {}
+    act['proof_thumbnail_url'] = get_secure_file_url(derivatives.get('webp'))
+    act['proof_thumbnail_fallback_url'] = get_secure_file_url(derivatives.get('jpg'))
+
     return act
 
 
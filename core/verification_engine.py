@@ -1,74 +1,62 @@
-from services.models import get_user_activities, create_verification, update_activity
+from services.models import (
+    get_user, get_user_activities, get_activities_to_verify, commit_verification_run,
+    iter_user_pages, get_job_checkpoint, save_job_checkpoint
+)
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import logging
+import threading
+import time
+from core.grading_rules import grade, grade_many
 
 
-# Lightweight grading rules based on OffSec handbook (simplified):
-# - course: 1 CPE per hour, cap 40 for typical course mapping
-# - webinar/conference: 1 CPE per hour
-# - public_speaking / published_paper: fixed 4 CPEs per event/paper
-# - lab_submission: 20 CPEs if accepted (external acceptance required)
-
 def grade_activity(activity):
-    """Return (awarded_cpe:int/float or None, reason:str, auto_approved:bool)."""
-    atype = (activity.get('activity_type') or '').lower()
-    src = (activity.get('submission_source') or '').lower()
-    dur = activity.get('duration_hours')
-
-    # If already awarded, return existing
-    if activity.get('awarded_cpe') is not None:
-        return activity.get('awarded_cpe'), 'already_awarded', True
-
-    # Course: 1 CPE per hour, cap 40
-    if atype == 'course':
-        if dur:
-            awarded = float(dur)
-            if awarded > 40:
-                awarded = 40.0
-            return awarded, f'course_{awarded}_hours', True
-        # If no duration provided, pending manual review
-        return None, 'course_missing_duration', False
-
-    if atype in ('webinar', 'conference'):
-        if dur:
-            awarded = float(dur)
-            return awarded, f'{atype}_{awarded}_hours', True
-        return None, f'{atype}_missing_duration', False
-
-    if atype == 'public_speaking' or atype == 'published_paper':
-        # Fixed award per item; quick auto-approve if evidence exists
-        evidence = activity.get('proof_file') or activity.get('evidence_paths')
-        if evidence:
-            return 4.0, f'{atype}_standard', True
-        return None, f'{atype}_no_evidence', False
-
-    if atype == 'lab_submission':
-        # require acceptance flag for auto-approval
-        accepted = activity.get('accepted') or False
-        if accepted:
-            return 20.0, 'lab_submission_accepted', True
-        return None, 'lab_submission_pending_acceptance', False
-
-    # Default: if user provided explicit cpe_points and proof exists, accept it
-    if activity.get('cpe_points') is not None:
-        if activity.get('proof_file') or activity.get('evidence_paths'):
-            return float(activity.get('cpe_points')), 'user_provided_with_evidence', True
-        return None, 'user_provided_no_evidence', False
-
-    return None, 'unable_to_grade', False
-
-
-def verify_activities(uid):
-    """Grade and create verification records for a user's activities."""
-    activities = get_user_activities(uid) or []
-    verifications = []
-
-    for activity in activities:
+    """
+    Return (awarded_cpe:int/float or None, reason:str, auto_approved:bool).
+    Rules live in core.grading_rules, shared with the n8n auto-grade workflow.
+    """
+    return grade(activity)
+
+
+def _is_admin_reviewed(activity):
+    """True for activities an admin approved/rejected and the user has not changed since."""
+    return bool(activity.get('awarded_by')) and (
+        not activity.get('graded_at') or activity.get('graded_at') == activity.get('updated_at')
+    )
+
+
+def verify_activities(uid, full=False, throttle=None):
+    """
+    Grade a user's activities and record one verification per activity.
+
+    Only drafts, pending activities and those changed since the user's
+    `verification_watermark` are graded; the first run (or full=True) grades
+    everything. Verification records use deterministic ids, so re-grading an
+    activity overwrites its record instead of adding another. Admin
+    decisions are never re-graded, not even with full=True.
+
+    All writes of the run go out in chunked batches, and certificate and
+    credit totals are recomputed once at the end. `throttle(n)`, if given,
+    is called with the number of writes before they are sent.
+    Returns (verification records, number of activities whose writes failed).
+    """
+    run_started = datetime.utcnow()
+    since = None if full else (get_user(uid) or {}).get('verification_watermark')
+    if since is None:
+        activities = get_user_activities(uid) or []
+    else:
+        activities = get_activities_to_verify(uid, since)
+    activities = [a for a in activities if not _is_admin_reviewed(a)]
+
+    records = {}
+    approvals = {}
+    cert_ids = set()
+    for activity, (awarded_cpe, reason, auto) in zip(activities, grade_many(activities)):
         activity_id = activity.get('id') or activity.get('activity_id')
-        awarded_cpe, reason, auto = grade_activity(activity)
 
         status = 'verified' if awarded_cpe is not None and auto else 'pending'
 
-        verif_record = {
+        records[activity_id] = {
             'activity_id': activity_id,
             'status': status,
             'user_id': uid,
@@ -78,21 +66,135 @@ def verify_activities(uid):
             'verified_at': datetime.utcnow() if status == 'verified' else None
         }
 
-        # persist verification record
-        create_verification(uid, verif_record)
-        verifications.append(verif_record)
-
         # update activity doc with awarded values if approved
         if awarded_cpe is not None and auto:
-            try:
-                update_activity(uid, activity_id, {
-                    'awarded_cpe': awarded_cpe,
-                    'awarded_reason': reason,
-                    'status': 'approved',
-                    'updated_at': datetime.utcnow()
-                })
-            except Exception:
-                # best-effort: continue
-                pass
-
-    return verifications
+            graded_at = datetime.utcnow()
+            approvals[activity_id] = {
+                'awarded_cpe': awarded_cpe,
+                'awarded_reason': reason,
+                'status': 'approved',
+                # equal timestamps mark this write as our own, not a user change
+                'graded_at': graded_at,
+                'updated_at': graded_at
+            }
+            cert_ids.add(activity.get('certification_id'))
+
+    # Changes made while this run was grading are picked up by the next one
+    _, failed = commit_verification_run(
+        uid, records, approvals, cert_ids, watermark=run_started, throttle=throttle
+    )
+    return list(records.values()), failed
+
+
+# =====================
+# CROSS-USER RUNS (nightly re-grading)
+# =====================
+def write_throttle(writes_per_second):
+    """
+    Return a blocking throttle(n) shared by all workers that keeps document
+    writes under `writes_per_second` (a token bucket holding one second's
+    worth of writes). Returns None when unlimited.
+    """
+    if not writes_per_second:
+        return None
+    lock = threading.Lock()
+    state = {'tokens': float(writes_per_second), 'at': time.monotonic()}
+
+    def throttle(n):
+        with lock:
+            now = time.monotonic()
+            state['tokens'] = min(
+                float(writes_per_second), state['tokens'] + (now - state['at']) * writes_per_second
+            )
+            state['at'] = now
+            state['tokens'] -= n
+            # Sleep off any debt while holding the lock so workers queue in order
+            if state['tokens'] < 0:
+                time.sleep(-state['tokens'] / writes_per_second)
+    return throttle
+
+
+def _verify_user(user, full, throttle):
+    try:
+        records, failed = verify_activities(user['uid'], full=full, throttle=throttle)
+        if failed:
+            return user, len(records) - failed, RuntimeError(f"{failed} activity write(s) failed")
+        return user, len(records), None
+    except Exception as e:
+        return user, 0, e
+
+
+def _with_run_counts(counts, resumed):
+    """Run totals plus what this invocation did itself (totals minus resumed progress)."""
+    return {
+        **counts,
+        'run_processed': counts['processed'] - resumed['processed'],
+        'run_activities': counts['activities'] - resumed['activities'],
+    }
+
+
+def verify_all_users(workers=8, page_size=200, resume=True, full=False,
+                     writes_per_second=None, job_name='verify_all_users', on_page=None):
+    """
+    Run verify_activities for every user with a bounded thread pool.
+
+    Users are paged by document id and progress is checkpointed in
+    jobs/{job_name} after every page, so an interrupted run resumes after the
+    last completed page. Users that fail are kept in the checkpoint's
+    failed_uids and retried once after the last page (or when an interrupted
+    run resumes); `failed` counts those that still fail. Writes across all
+    workers, including recomputed totals, are capped at writes_per_second.
+    on_page(counts, elapsed_seconds) is called after each page. Returns
+    aggregate counts; counts cover the whole run including resumed
+    progress, while run_processed and run_activities cover only this call
+    (use those for rates).
+    """
+    logger = logging.getLogger(__name__)
+    checkpoint = get_job_checkpoint(job_name) if resume else None
+    if checkpoint and checkpoint.get('status') == 'running':
+        start_after = checkpoint.get('last_uid')
+        counts = dict(checkpoint.get('counts') or {})
+        failed_uids = list(checkpoint.get('failed_uids') or [])
+    else:
+        start_after = None
+        counts = {}
+        failed_uids = []
+    for key in ('processed', 'activities'):
+        counts.setdefault(key, 0)
+    counts['failed'] = len(failed_uids)
+    resumed = dict(counts)
+
+    save_job_checkpoint(job_name, {
+        'status': 'running', 'last_uid': start_after, 'counts': counts, 'failed_uids': failed_uids
+    })
+    throttle = write_throttle(writes_per_second)
+    started = time.monotonic()
+
+    def run(pool, users, retry=False):
+        for user, graded, error in pool.map(lambda u: _verify_user(u, full, throttle), users):
+            if not retry:
+                counts['processed'] += 1
+            counts['activities'] += graded
+            if error:
+                logger.error(f"Verification failed for {user['uid']}: {error}")
+                if user['uid'] not in failed_uids:
+                    failed_uids.append(user['uid'])
+            elif retry:
+                failed_uids.remove(user['uid'])
+        counts['failed'] = len(failed_uids)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='verify-bulk') as pool:
+        for page in iter_user_pages(page_size, start_after, fields=()):
+            run(pool, page)
+            save_job_checkpoint(job_name, {
+                'last_uid': page[-1]['uid'], 'counts': counts, 'failed_uids': failed_uids
+            })
+            if on_page:
+                on_page(_with_run_counts(counts, resumed), time.monotonic() - started)
+
+        if failed_uids:
+            logger.info(f"Retrying {len(failed_uids)} failed user(s)")
+            run(pool, [{'uid': uid} for uid in list(failed_uids)], retry=True)
+
+    save_job_checkpoint(job_name, {'status': 'completed', 'counts': counts, 'failed_uids': failed_uids})
+    return {**_with_run_counts(counts, resumed), 'elapsed_seconds': round(time.monotonic() - started, 1)}
@@ -1,20 +1,24 @@
 from flask import Blueprint, request, jsonify, render_template, g, redirect, url_for, flash, session, send_file, make_response, current_app
 from firebase_admin import auth, firestore, storage
-from services.middleware import firebase_required, admin_required  
+from services.middleware import firebase_required, admin_required, public, webhook, conditional_feed
 from services.firebase_config import db
+from services.replica import events_replica, recommendations_replica
 from services.models import (
-    create_user, get_user,
-    create_activity, get_user_activities,
+    create_user, get_user, update_user,
+    create_activity, get_activity, get_user_activities, set_activity_proof_derivatives, set_profile_image_derivatives,
+    release_proof_blob,
     create_certificate, get_user_certificates,
-    create_recommendation, get_user_recommendations,
-    create_verification, get_user_verifications,
+    create_recommendation, get_user_recommendations, get_approved_recommendations,
+    get_user_verifications, review_activities_bulk,
+    get_pending_activities_page, count_pending_activities, attach_owner_context,
     get_certificate, update_certificate, delete_certificate, 
-    create_event, get_all_events,
+    create_event, get_all_events, get_events_by_user, get_upcoming_events, normalize_event_date,
+    bump_collection_version,
     get_event, update_event, delete_event
 
 )
 from forms import RegistrationForm, LoginForm, CertificateForm, ActivityForm, UpdateProfileForm, AddRecommendationForm, EditRecommendationForm, NewsletterEventForm
-from datetime import datetime, date
+from datetime import datetime, date, timezone
 from core.utils import generate_csv_report, generate_pdf_report, normalize_cert, normalize_activity, get_secure_file_url, build_dashboard_data
 def evaluate_group_a_compliance(uid, cert):
     """
@@ -116,24 +120,100 @@ def evaluate_annual_compliance(uid, cert):
 
     return yearly_status
 
-from core.recommendation_engine import generate_recommendations
+def build_recommendation_gaps(uid, certs):
+    """
+    Summarizes what each of the user's authorities still needs, as input to
+    recommendation ranking. Returns {authority: gap dict}; certifications of
+    the same authority are merged by taking the larger need.
+    """
+    gaps = {}
+    today = date.today()
+
+    for cert in certs:
+        rules = MASTER_CERT_DB.get(normalize_cert(cert.get("name", "")), {})
+        authority = rules.get("authority") or normalize_authority(cert.get("authority"))
+        if not authority:
+            continue
+
+        required = float(cert.get("required_cpes") or rules.get("total_cpes") or 0)
+        earned = float(cert.get("earned_cpes") or 0)
+        gap = {"required": required, "remaining": max(required - earned, 0)}
+
+        group_a = evaluate_group_a_compliance(uid, cert)
+        if group_a:
+            gap["group_a_required"] = group_a["group_a_required"]
+            gap["group_a_remaining"] = group_a["group_a_remaining"]
+
+        annual_min = rules.get("annual_min")
+        if annual_min:
+            this_year = (evaluate_annual_compliance(uid, cert) or {}).get(today.year)
+            gap["annual_required"] = annual_min
+            gap["annual_remaining"] = this_year["remaining"] if this_year else annual_min
+
+        renewal = cert.get("renewal_date")
+        if isinstance(renewal, str):
+            try:
+                renewal = datetime.fromisoformat(renewal)
+            except ValueError:
+                renewal = None
+        if isinstance(renewal, datetime):
+            renewal = renewal.date()
+        if isinstance(renewal, date):
+            gap["days_to_renewal"] = (renewal - today).days
+
+        merged = gaps.setdefault(authority, {})
+        for field, value in gap.items():
+            if field == "days_to_renewal":
+                merged[field] = min(value, merged.get(field, value))
+            else:
+                merged[field] = max(value, merged.get(field, 0))
+
+    return gaps
+
+from core.recommendation_engine import generate_recommendations, generate_recommendations_page, JobBusy
+from core.recommendation_ranking import get_ranked_recommendations
+from core.calendar_feed import get_calendar_feed, MAX_FEED_EVENTS
 from core.verification_engine import verify_activities
+from core.grading_rules import GRADING_RULES
 from core.pdf_generator import generate_cpe_report
+from core.auth_utils import SESSION_COOKIE_MODE, SESSION_COOKIE_NAME, revoke_firebase_session_cookie
+from core.upload_pipeline import stream_upload, store_proof_file, spool_upload, UploadRejected
+from core.image_derivatives import schedule_derivatives
+from core.background_uploads import (
+    ASYNC_PROOF_UPLOADS, reserve_upload_slot, release_upload_slot, submit_proof_upload
+)
 from werkzeug.utils import secure_filename
 from uuid import uuid4
 from google.cloud.firestore import FieldFilter
 import os
-import mimetypes
+import time
 
 
 routes_bp = Blueprint('routes', __name__)
 
 # Import limiter after Blueprint creation to avoid circular import
-from app import limiter
+from app import limiter, csrf
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
-MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10 MB
-SAFE_MIME_TYPES = {'image/png', 'image/jpeg', 'application/pdf'}
+
+# Relevance ranking: candidate pool when the replica is unavailable, and how
+# long a ranking built from that query may be reused (seconds)
+RANKING_POOL_SIZE = 500
+RANKING_QUERY_TTL = 300
+# Paging cursor for the first page of unranked items after a full ranked page
+RANKED_TAIL_CURSOR = '-'
+
+# Events per page on the creator's own newsletter list and the events page
+MY_EVENTS_PAGE_SIZE = 50
+EVENTS_PAGE_SIZE = 50
+
+# Most activities an admin can approve/reject in one bulk request
+BULK_REVIEW_LIMIT = 500
+ADMIN_QUEUE_PAGE_SIZE = 50
+
+# Users processed per /recommendations/generate-all call (kept well under
+# the worker timeout; the caller repeats until done)
+BULK_GENERATION_PAGE_SIZE = 50
 
 
 MASTER_CERT_DB = {
@@ -566,23 +646,14 @@ def normalize_authority(text):
 
 def validate_file_upload(file_obj):
     """
-    Validates uploaded file: extension, MIME type, size.
+    Validates the uploaded file's name and extension.
+    Size and content (magic bytes) are checked by the upload pipeline while
+    the file is streamed, so the stream is not read here.
     Returns (is_valid: bool, error_message: str or None)
     """
     if not file_obj or file_obj.filename == '':
         return False, 'No file selected'
 
-    # Check file size
-    file_obj.seek(0, 2)  # Seek to end
-    file_size = file_obj.tell()
-    file_obj.seek(0)  # Reset to start
-    
-    if file_size > MAX_UPLOAD_SIZE:
-        return False, f'File too large (max {MAX_UPLOAD_SIZE / 1024 / 1024:.0f} MB)'
-    
-    if file_size == 0:
-        return False, 'File is empty'
-
     # Check extension
     filename = secure_filename(file_obj.filename)
     if '.' not in filename:
@@ -592,14 +663,6 @@ def validate_file_upload(file_obj):
     if ext not in ALLOWED_EXTENSIONS:
         return False, f'File type not allowed. Allowed: {", ".join(ALLOWED_EXTENSIONS)}'
 
-    # Check MIME type
-    mime_type, _ = mimetypes.guess_type(filename)
-    if mime_type not in SAFE_MIME_TYPES:
-        # Try content-type header as fallback
-        content_type = file_obj.content_type or ''
-        if content_type not in SAFE_MIME_TYPES:
-            return False, f'Invalid file MIME type: {mime_type or content_type}'
-
     return True, None
 
 
@@ -607,6 +670,7 @@ def validate_file_upload(file_obj):
 # API Endpoints
 # =====================
 @routes_bp.route('/api/cert-search')
+@public
 def cert_search():
     q = normalize_cert(request.args.get("q", ""))
     if len(q) < 2:
@@ -617,6 +681,7 @@ def cert_search():
 
 
 @routes_bp.route('/api/cert-autofill')
+@public
 def cert_autofill():
     name = normalize_cert(request.args.get("name", ""))
     data = MASTER_CERT_DB.get(name)
@@ -633,6 +698,7 @@ def cert_autofill():
     })
 
 @routes_bp.route('/api/activity-rules')
+@public
 def activity_rules():
     cert_name = normalize_cert(request.args.get("cert", ""))
 
@@ -757,10 +823,12 @@ def activity_projection():
 # Public Pages
 # =====================
 @routes_bp.route('/', methods=['GET'], endpoint='index')
+@public
 def index():
     return render_template('index.html')
 
 @routes_bp.route('/login', methods=['GET'], endpoint='login_page')
+@public
 @limiter.limit('5 per 15 minutes')
 def login_page():
     form = LoginForm()
@@ -772,6 +840,7 @@ def login_page():
     return render_template('login.html', form=form, firebase_config=firebase_config)
 
 @routes_bp.route('/register', methods=['GET', 'POST'], endpoint='register_page')
+@public
 @limiter.limit('3 per 1 hour')
 def register_page():
     form = RegistrationForm()
@@ -798,11 +867,18 @@ def register_page():
     
     return render_template('register.html', form=form)
 
-@routes_bp.route('/logout', methods=['GET'], endpoint='logout')
+# POST only (CSRF-checked): in cookie mode logout revokes every session the
+# user has, which a cross-site GET (e.g. an <img src>) must not trigger
+@routes_bp.route('/logout', methods=['POST'], endpoint='logout')
+@public
 def logout():
     session.clear()
     flash("You have been logged out.", "success")
-    return redirect(url_for('routes.login_page'))
+    response = redirect(url_for('routes.login_page'))
+    if SESSION_COOKIE_MODE:
+        revoke_firebase_session_cookie(request.cookies.get(SESSION_COOKIE_NAME))
+        response.delete_cookie(SESSION_COOKIE_NAME)
+    return response
 
 # =====================
 # Dashboard
@@ -932,15 +1008,19 @@ def cert_recommendations_page(cert_id):
     cert_norm = normalize_cert(cert)
 
     try:
-        rec_docs = (
-            db.collection("recommendations")
-              .where("approved", "==", True)
-              .order_by("created_at", direction=firestore.Query.DESCENDING)
-              .stream()
-        )
+        replica = recommendations_replica()
+        if replica:
+            rec_list = replica.newest()
+        else:
+            rec_docs = (
+                db.collection("recommendations")
+                  .where("approved", "==", True)
+                  .order_by("created_at", direction=firestore.Query.DESCENDING)
+                  .stream()
+            )
+            rec_list = [doc.to_dict() for doc in rec_docs]
         recommendations = []
-        for doc in rec_docs:
-            r = doc.to_dict()
+        for r in rec_list:
             recommendations.append({
                 "title": r.get("title", ""),
                 "description": r.get("description", ""),
@@ -1024,6 +1104,7 @@ def add_activity():
     if request.method == 'POST' and form.validate_on_submit():
         # File upload (optional)
         proof_file_name = None
+        spooled_proof = None
         if form.proof_file.data:
             uploaded_file = form.proof_file.data
             
@@ -1033,15 +1114,20 @@ def add_activity():
                 flash(f'File upload error: {error_msg}', 'danger')
                 return render_template('add_activity.html', form=form)
             
-            filename = secure_filename(uploaded_file.filename)
-            unique_name = f"{uid}/{uuid4().hex}_{filename}"
-            
-            # Upload to Firebase Storage
             try:
-                bucket = storage.bucket()
-                blob = bucket.blob(f"proofs/{unique_name}")
-                blob.upload_from_file(uploaded_file, content_type=uploaded_file.content_type)
-                proof_file_name = blob.name
+                if ASYNC_PROOF_UPLOADS and reserve_upload_slot():
+                    # Validate into a temp file now; the transfer runs after the redirect
+                    try:
+                        spooled_proof, _ = spool_upload(uploaded_file.stream)
+                    except Exception:
+                        release_upload_slot()
+                        raise
+                else:
+                    # Validate and hash the file; identical proofs share one stored blob
+                    proof_file_name = store_proof_file(uid, uploaded_file.stream)
+            except UploadRejected as e:
+                flash(f'File upload error: {e}', 'danger')
+                return render_template('add_activity.html', form=form)
             except Exception as e:
                 current_app.logger.error(f"Storage upload failed: {e}")
                 flash('File upload failed. Please check storage configuration or try again without a file.', 'danger')
@@ -1055,13 +1141,31 @@ def add_activity():
             'description': form.description.data,
             'activity_date': form.activity_date.data.isoformat() if form.activity_date.data else None,
             'proof_file': proof_file_name,
+            'proof_status': 'uploading' if spooled_proof else ('ready' if proof_file_name else None),
             'user_id': uid,
             'awarded_cpe': None,
             'status': 'draft',
             'created_at': datetime.utcnow()
         }
         
-        create_activity(uid, activity_data)
+        try:
+            activity_id = create_activity(uid, activity_data)
+        except Exception:
+            if spooled_proof:
+                spooled_proof.close()
+                release_upload_slot()
+            elif proof_file_name:
+                # Drop the reference store_proof_file took for this activity
+                release_proof_blob(uid, proof_file_name)
+            raise
+
+        if spooled_proof:
+            submit_proof_upload(uid, activity_id, spooled_proof)
+        elif proof_file_name:
+            schedule_derivatives(
+                proof_file_name, 'thumb',
+                on_complete=lambda paths: set_activity_proof_derivatives(uid, activity_id, proof_file_name, paths)
+            )
         flash('Activity logged successfully!', 'success')
         return redirect(url_for('routes.list_activities'))
 
@@ -1103,6 +1207,7 @@ def edit_activity(activity_id):
     if request.method == 'POST' and form.validate_on_submit():
         # File upload (optional - use existing if not changed)
         proof_file_name = activity.get('proof_file')
+        proof_stored = False
         if form.proof_file.data:
             uploaded_file = form.proof_file.data
             
@@ -1111,13 +1216,16 @@ def edit_activity(activity_id):
                 flash(f'File upload error: {error_msg}', 'danger')
                 return render_template('edit_activity.html', form=form, activity=activity)
             
-            filename = secure_filename(uploaded_file.filename)
-            unique_name = f"{uid}/{uuid4().hex}_{filename}"
-            
-            bucket = storage.bucket('credpoint-16422.appspot.com''credpoint-16422.appspot.com')
-            blob = bucket.blob(f"proofs/{unique_name}")
-            blob.upload_from_file(uploaded_file, content_type=uploaded_file.content_type)
-            proof_file_name = blob.name
+            try:
+                proof_file_name = store_proof_file(uid, uploaded_file.stream)
+                proof_stored = True
+            except UploadRejected as e:
+                flash(f'File upload error: {e}', 'danger')
+                return render_template('edit_activity.html', form=form, activity=activity)
+            except Exception as e:
+                current_app.logger.error(f"Storage upload failed: {e}")
+                flash('File upload failed. Please try again.', 'danger')
+                return render_template('edit_activity.html', form=form, activity=activity)
 
         # Update only basic activity data
         updated_data = {
@@ -1128,9 +1236,22 @@ def edit_activity(activity_id):
             'activity_date': form.activity_date.data.isoformat() if form.activity_date.data else None,
             'proof_file': proof_file_name,
         }
+        if proof_file_name != activity.get('proof_file'):
+            updated_data['proof_derivatives'] = None
 
-        from services.models import update_activity
-        update_activity(uid, activity_id, updated_data)
+        from services.models import update_activity, replace_activity_proof
+        if proof_stored:
+            # Swaps the reference store_proof_file took for the previous file's
+            replace_activity_proof(uid, activity_id, updated_data, activity.get('proof_file'))
+        else:
+            update_activity(uid, activity_id, updated_data)
+
+        # New proof content: render thumbnails for it
+        if proof_file_name != activity.get('proof_file'):
+            schedule_derivatives(
+                proof_file_name, 'thumb',
+                on_complete=lambda paths: set_activity_proof_derivatives(uid, activity_id, proof_file_name, paths)
+            )
 
         flash('Activity updated successfully!', 'success')
         return redirect(url_for('routes.list_activities'))
@@ -1148,6 +1269,20 @@ def delete_activity(activity_id):
         flash(f'Error deleting activity: {str(e)}', 'danger')
     return redirect(url_for('routes.list_activities'))
 
+@routes_bp.route('/activities/<activity_id>/proof-status', methods=['GET'], endpoint='activity_proof_status')
+@firebase_required
+def activity_proof_status(activity_id):
+    """Report progress of a background proof upload (polled by the activity list)."""
+    activity = get_activity(g.uid, activity_id)
+    if not activity:
+        return jsonify({'error': 'Activity not found'}), 404
+
+    proof_file = activity.get('proof_file')
+    return jsonify({
+        'proof_status': activity.get('proof_status') or ('ready' if proof_file else None),
+        'proof_file_url': get_secure_file_url(proof_file) if proof_file else None
+    })
+
 # =====================
 # Recommendations Routes
 # =====================
@@ -1186,9 +1321,12 @@ def add_recommendation():
 # Recommendations API (for n8n workflows)
 # =====================
 @routes_bp.route('/recommendations/generate', methods=['POST'])
+@csrf.exempt
+@webhook('JOB_API_TOKEN', header='X-Job-Token')
 def generate_recommendations_api():
     """
     API endpoint for n8n to trigger recommendation generation.
+    Requires the X-Job-Token header to match JOB_API_TOKEN.
     Accepts JSON: {"uid": "user_id", "force_generate": true}
     """
     try:
@@ -1206,6 +1344,33 @@ def generate_recommendations_api():
         current_app.logger.error(f"Error generating recommendations for {uid}: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@routes_bp.route('/recommendations/generate-all', methods=['POST'])
+@csrf.exempt
+@webhook('JOB_API_TOKEN', header='X-Job-Token')
+def generate_recommendations_bulk_api():
+    """
+    Daily job endpoint: generate recommendations for the next page of users.
+    Each call processes one page and returns the run's totals plus "done";
+    the caller repeats until done is true (the CLI command runs all pages).
+    Requires the X-Job-Token header to match JOB_API_TOKEN.
+    Accepts JSON: {"workers": 8, "page_size": 50, "resume": true, "include_users": false}
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        result = generate_recommendations_page(
+            workers=min(int(data.get('workers', 8)), 32),
+            page_size=min(int(data.get('page_size', BULK_GENERATION_PAGE_SIZE)), 200),
+            resume=bool(data.get('resume', True)),
+            collect_users=bool(data.get('include_users', False))
+        )
+        return jsonify({'success': True, **result}), 200
+    except JobBusy as e:
+        # Another caller is on this run; retry once its page is committed
+        return jsonify({'success': False, 'busy': True, 'error': str(e)}), 409
+    except Exception as e:
+        current_app.logger.error(f"Bulk recommendation generation failed: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @routes_bp.route("/recommendations/pending", methods=["GET"])
 @firebase_required
 def pending_recommendations():
@@ -1220,21 +1385,20 @@ def pending_recommendations():
 @firebase_required
 @admin_required
 def admin_pending_cpe():
+    """Pending CPE queue, oldest submission first, a page at a time (`after` cursor)."""
+    pending, next_cursor, total = [], None, None
     try:
-        docs = db.collection_group('activities').where('status', '==', 'pending').stream()
-        pending = []
-        for doc in docs:
-            a = doc.to_dict()
-            # determine user id from document path (users/{uid}/activities/{activity_id})
-            parent = doc.reference.parent.parent
-            user_id = parent.id if parent is not None else None
-            a['activity_id'] = doc.id
-            a['user_id'] = user_id
-            pending.append(a)
+        pending, next_cursor = get_pending_activities_page(
+            ADMIN_QUEUE_PAGE_SIZE, request.args.get('after') or None
+        )
+        # names, emails and cert names for the whole page in one round trip
+        attach_owner_context(pending)
+        total = count_pending_activities()
     except Exception as e:
         current_app.logger.error(f"Error fetching pending CPEs: {e}")
-        pending = []
-    return render_template('admin_pending_verifications.html', pending=pending)
+    return render_template(
+        'admin_pending_verifications.html', pending=pending, next_cursor=next_cursor, total=total
+    )
 
 @routes_bp.route('/admin/approve/<string:user_id>/<string:activity_id>', methods=['POST'])
 @firebase_required
@@ -1243,51 +1407,114 @@ def admin_approve_activity(user_id, activity_id):
     awarded = request.form.get('awarded_cpe')
     reason = request.form.get('reason') or 'approved_by_admin'
     try:
-        activity_ref = db.collection('users').document(user_id).collection('activities').document(activity_id)
-        update_payload = {
-            'status': 'approved',
-            'awarded_cpe': float(awarded) if awarded else None,
-            'awarded_reason': reason,
-            'awarded_by': g.uid,
-            'updated_at': datetime.utcnow()
-        }
-        activity_ref.update(update_payload)
-
-        ver = {
-            'activity_id': activity_id,
-            'status': 'verified',
+        # Same write path as bulk review: activity + verification record in one batch
+        _, failed = review_activities_bulk(g.uid, [{
             'user_id': user_id,
+            'activity_id': activity_id,
+            'status': 'approved',
             'awarded_cpe': float(awarded) if awarded else None,
-            'reason': reason,
-            'auto_approved': False,
-            'verified_at': datetime.utcnow()
-        }
-        create_verification(user_id, ver)
+            'reason': reason
+        }])
+        if failed:
+            raise ValueError('activity update failed')
         flash('Activity approved successfully.', 'success')
     except Exception as e:
         current_app.logger.error(f"Error approving activity {activity_id} for user {user_id}: {e}")
         flash('Error approving activity.', 'danger')
     return redirect(url_for('routes.admin_pending_cpe'))
 
+def _bulk_review_item_error(item):
+    """Why a bulk review item is malformed, or None if it is usable."""
+    if not isinstance(item, dict):
+        return 'item must be an object'
+    for field in ('user_id', 'activity_id'):
+        value = item.get(field)
+        # Ids become Firestore document ids, which cannot contain '/'
+        if not isinstance(value, str) or not value or '/' in value:
+            return f'{field} must be a non-empty id string'
+    return None
+
+@routes_bp.route('/admin/pending-cpe/bulk', methods=['POST'], endpoint='admin_bulk_review')
+@firebase_required
+@admin_required
+def admin_bulk_review():
+    """
+    Approve or reject many pending activities in one request.
+    Accepts JSON: {"action": "approve"|"reject", "reason": "...",
+                   "items": [{"user_id", "activity_id", "awarded_cpe"}]}
+    and returns a summary; the pending queue is not reloaded. Malformed
+    items are rejected with 400 and listed by index; items whose only
+    problem is an unparseable awarded_cpe are skipped and listed as invalid.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'JSON object body required'}), 400
+    action = data.get('action')
+    items = data.get('items') or []
+    if action not in ('approve', 'reject') or not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'error': 'action and items are required'}), 400
+    if len(items) > BULK_REVIEW_LIMIT:
+        return jsonify({'success': False, 'error': f'at most {BULK_REVIEW_LIMIT} items per request'}), 400
+    reason = data.get('reason') or ''
+    if not isinstance(reason, str):
+        return jsonify({'success': False, 'error': 'reason must be a string'}), 400
+
+    bad = []
+    for index, item in enumerate(items):
+        error = _bulk_review_item_error(item)
+        if error:
+            bad.append({'index': index, 'error': error})
+    if bad:
+        return jsonify({'success': False, 'error': f'{len(bad)} malformed item(s)', 'bad_items': bad}), 400
+
+    default_reason = 'approved_by_admin' if action == 'approve' else 'rejected_by_admin'
+    reason = reason.strip() or default_reason
+    decisions, invalid = [], []
+    for item in items:
+        user_id, activity_id = item['user_id'], item['activity_id']
+        awarded = None
+        if action == 'approve' and item.get('awarded_cpe') not in (None, ''):
+            try:
+                awarded = float(item['awarded_cpe'])
+            except (TypeError, ValueError):
+                invalid.append({'user_id': user_id, 'activity_id': activity_id})
+                continue
+        decisions.append({
+            'user_id': user_id,
+            'activity_id': activity_id,
+            'status': 'approved' if action == 'approve' else 'rejected',
+            'awarded_cpe': awarded,
+            'reason': reason
+        })
+
+    try:
+        done, failed = review_activities_bulk(g.uid, decisions)
+    except Exception as e:
+        current_app.logger.error(f"Bulk review failed: {e}")
+        return jsonify({'success': False, 'error': 'bulk review failed'}), 500
+
+    return jsonify({
+        'success': True,
+        'action': action,
+        'processed': [{'user_id': u, 'activity_id': a} for u, a in done],
+        'failed': [{'user_id': u, 'activity_id': a} for u, a in failed],
+        'invalid': invalid
+    })
+
 @routes_bp.route('/admin/reject/<string:user_id>/<string:activity_id>', methods=['POST'])
 @firebase_required
 @admin_required
 def admin_reject_activity(user_id, activity_id):
     reason = request.form.get('reason') or 'rejected_by_admin'
     try:
-        activity_ref = db.collection('users').document(user_id).collection('activities').document(activity_id)
-        activity_ref.update({'status': 'rejected', 'awarded_reason': reason, 'awarded_by': g.uid, 'updated_at': datetime.utcnow()})
-
-        ver = {
+        _, failed = review_activities_bulk(g.uid, [{
+            'user_id': user_id,
             'activity_id': activity_id,
             'status': 'rejected',
-            'user_id': user_id,
-            'awarded_cpe': None,
-            'reason': reason,
-            'auto_approved': False,
-            'verified_at': datetime.utcnow()
-        }
-        create_verification(user_id, ver)
+            'reason': reason
+        }])
+        if failed:
+            raise ValueError('activity update failed')
         flash('Activity rejected.', 'info')
     except Exception as e:
         current_app.logger.error(f"Error rejecting activity {activity_id} for user {user_id}: {e}")
@@ -1339,6 +1566,7 @@ def edit_recommendation(rec_id):
             "url": form.url.data,
             "expires_at": expires_at_datetime  # Corrected variable
         })
+        bump_collection_version("recommendations")
         flash("Recommendation updated successfully!", "success")
         return redirect(url_for("routes.my_recommendations"))
 
@@ -1351,6 +1579,7 @@ def delete_own_recommendation(rec_id):
     rec = rec_ref.get()
     if rec.exists and rec.to_dict().get("created_by_uid") == g.uid:
         rec_ref.delete()
+        bump_collection_version("recommendations")
         flash("Recommendation deleted!", "success")
     return redirect(url_for("routes.my_recommendations"))
 
@@ -1493,11 +1722,13 @@ def profile_page():
                 if ext in ALLOWED_EXTENSIONS:
                     blob_path = f"profiles/{uid}_{int(datetime.utcnow().timestamp())}.{ext}"
                     try:
-                        bucket = storage.bucket()
-                        blob = bucket.blob(blob_path)
-                        blob.upload_from_file(file, content_type=file.content_type)
+                        upload = stream_upload(file.stream, blob_path)
                         # SECURITY: Store path, not public URL
-                        update_data["profile_image"] = blob.name
+                        update_data["profile_image"] = upload['blob_name']
+                        update_data["profile_image_derivatives"] = None
+                    except UploadRejected as e:
+                        flash(f'Profile image upload error: {e}', 'danger')
+                        return redirect(url_for('routes.profile_page'))
                     except Exception as e:
                         current_app.logger.error(f"Profile image upload failed: {e}")
                         flash('Profile image upload failed. Please check storage configuration.', 'danger')
@@ -1506,6 +1737,14 @@ def profile_page():
         if update_data:
             update_data["updated_at"] = datetime.utcnow()
             user_ref.update(update_data)
+            if update_data.get("profile_image"):
+                # Scheduled after the save: the job only records avatars for
+                # the image the profile still points at
+                profile_image = update_data["profile_image"]
+                schedule_derivatives(
+                    profile_image, 'avatar',
+                    on_complete=lambda paths: set_profile_image_derivatives(uid, profile_image, paths)
+                )
             flash("Profile updated successfully!", "success")
         else:
             flash("No changes made.", "info")
@@ -1530,9 +1769,13 @@ def profile_page():
     # Merge
     user_data = {**firestore_data, **auth_data}
 
-    # Generate signed URL for profile image if it's a storage path
+    # Generate signed URL for profile image if it's a storage path;
+    # prefer the resized derivatives once they have been rendered
     if user_data.get("profile_image"):
-        user_data["profile_image"] = get_secure_file_url(user_data["profile_image"])
+        derivatives = user_data.get("profile_image_derivatives") or {}
+        user_data["profile_image_original"] = get_secure_file_url(user_data["profile_image"])
+        user_data["profile_image"] = get_secure_file_url(derivatives.get("jpg")) or user_data["profile_image_original"]
+        user_data["profile_image_webp"] = get_secure_file_url(derivatives.get("webp"))
 
     # Format dates
     if "created_at" in firestore_data and firestore_data["created_at"]:
@@ -1550,11 +1793,21 @@ def profile_page():
 # =====================
 # Newsletter
 # =====================
+def _upcoming(events):
+    """Drop past events, matching what get_all_events() returns."""
+    now = datetime.utcnow()
+    return [
+        e for e in events
+        if not (isinstance(e.get('date'), datetime) and e['date'].replace(tzinfo=None) < now)
+    ]
+
 @routes_bp.route('/newsletter', methods=['GET'], endpoint='list_newsletter')
 @firebase_required
+@conditional_feed('events', per_user=True)
 def list_newsletter():
     """Show all events to everyone."""
-    raw = get_all_events() or []
+    replica = events_replica()
+    raw = _upcoming(replica.newest()) if replica else get_all_events() or []
     events = []
     for e in raw:
         if isinstance(e.get('created_at'), datetime):
@@ -1575,17 +1828,27 @@ def list_newsletter():
 @firebase_required
 def my_newsletter():
     """
-    Show events created by the logged-in user.
-    NOTE: we avoid a Firestore where+order_by composite index by
-    fetching events with get_all_events() and filtering in Python.
+    Show events created by the logged-in user, a page at a time.
+    Served from the in-memory events replica when it is live, otherwise
+    from an indexed per-user query, so the cost depends only on this
+    user's events. `after` is the id of the last event on the previous page.
     """
     uid = g.uid
+    start_after_id = request.args.get('after') or None
 
-    # get_all_events already orders by created_at desc in models.py
-    raw = get_all_events() or []
-
-    # client-side filter (safe for moderate dataset sizes)
-    events = [e for e in raw if e.get('created_by_uid') == uid]
+    replica = events_replica()
+    if replica:
+        # creator index in the in-memory replica; no Firestore reads
+        page = replica.newest(
+            limit=MY_EVENTS_PAGE_SIZE, created_by_uid=uid, start_after_id=start_after_id
+        )
+        # The cursor comes from the raw page, before past events are dropped
+        next_cursor = page[-1]['id'] if len(page) == MY_EVENTS_PAGE_SIZE else None
+        events = _upcoming(page)
+    else:
+        events, next_cursor = get_events_by_user(
+            uid, limit=MY_EVENTS_PAGE_SIZE, start_after_id=start_after_id
+        )
 
     # normalize display fields (same style as list_newsletter)
     for e in events:
@@ -1601,7 +1864,7 @@ def my_newsletter():
         else:
             e['date_display'] = str(ev_date or '')
 
-    return render_template('my_newsletter.html', events=events)
+    return render_template('my_newsletter.html', events=events, next_cursor=next_cursor)
 
 @routes_bp.route('/newsletter/add', methods=['GET', 'POST'], endpoint='add_newsletter')
 @firebase_required
@@ -1669,7 +1932,8 @@ def edit_newsletter(event_id):
             "link": form.link.data or None
         }
 
-        update_event(event_id, updated)
+        # ownership was checked above; skip the second read
+        update_event(event_id, updated, owner_checked=True)
         flash('Event updated successfully!', 'success')
         return redirect(url_for('routes.my_newsletter'))
 
@@ -1688,7 +1952,7 @@ def delete_newsletter(event_id):
         flash('You are not allowed to delete this event.', 'danger')
         return redirect(url_for('routes.my_newsletter'))
 
-    delete_event(event_id)
+    delete_event(event_id, owner_checked=True)
     flash('Event deleted successfully!', 'success')
     return redirect(url_for('routes.my_newsletter'))
 # Add this to the END of routes.py (after all existing routes)
@@ -1698,10 +1962,12 @@ def delete_newsletter(event_id):
 # =====================
 
 @routes_bp.route('/webhook/n8n/recommendations', methods=['POST'])
+@csrf.exempt
+@webhook('N8N_WEBHOOK_TOKEN')
 def webhook_recommendations():
     """
     Receive recommendations from n8n automation workflows.
-    No authentication required (public webhook).
+    Requires the X-Webhook-Token header to match N8N_WEBHOOK_TOKEN.
     """
     data = request.json or {}
     items = data.get("items", [])
@@ -1726,6 +1992,7 @@ def webhook_recommendations():
                 "approved": True
             })
         
+        bump_collection_version("recommendations")
         current_app.logger.info(f"n8n webhook: Added {len(items)} recommendations")
         return jsonify({"status": "ok", "imported": len(items)})
     
@@ -1735,23 +2002,39 @@ def webhook_recommendations():
 
 
 @routes_bp.route('/webhook/n8n/events', methods=['POST'])
+@csrf.exempt
+@webhook('N8N_WEBHOOK_TOKEN')
 def webhook_events():
     """
     Receive events from n8n automation workflows.
-    No authentication required (public webhook).
+    Requires the X-Webhook-Token header to match N8N_WEBHOOK_TOKEN.
+    Every item needs a parseable date; otherwise nothing is stored and the
+    bad items are listed by index with a 400.
     """
     data = request.json or {}
-    items = data.get("items", [])
+    items = data.get("items", []) if isinstance(data, dict) else []
 
-    if not items:
+    if not items or not isinstance(items, list):
         return jsonify({"status": "error", "message": "No items provided"}), 400
 
+    # A missing date must not become "now": the event would be stored as
+    # already past and removed by the next expiry sweep
+    dates, bad = [], []
+    for index, item in enumerate(items):
+        event_date = normalize_event_date(item.get("date")) if isinstance(item, dict) else None
+        if event_date is None:
+            bad.append({"index": index, "date": item.get("date") if isinstance(item, dict) else None})
+        dates.append(event_date)
+    if bad:
+        return jsonify({"status": "error", "message": "Items without a valid ISO-8601 date", "invalid": bad}), 400
+
     try:
-        for item in items:
+        for item, event_date in zip(items, dates):
             db.collection("events").add({
                 "title": item.get("title", ""),
                 "description": item.get("description", ""),
-                "date": item.get("date", datetime.utcnow().isoformat()),
+                # Stored as a timestamp so upcoming-event range queries match it
+                "date": event_date,
                 "link": item.get("link", ""),
                 "location": item.get("location", "Online"),
                 "tags": item.get("tags", ["webinar"]),
@@ -1760,6 +2043,7 @@ def webhook_events():
                 "created_by_uid": None  # System-generated
             })
         
+        bump_collection_version("events")
         current_app.logger.info(f"n8n webhook: Added {len(items)} events")
         return jsonify({"status": "ok", "imported": len(items)})
     
@@ -1773,6 +2057,8 @@ def webhook_events():
 # =====================
 
 @routes_bp.route('/api/recommendations/latest', methods=['GET'])
+@public
+@conditional_feed('recommendations')
 def api_recommendations_latest():
     """
     Public API endpoint: Get latest approved recommendations.
@@ -1782,6 +2068,11 @@ def api_recommendations_latest():
         limit = int(request.args.get('limit', 20))
         authority = request.args.get('authority', None)
         
+        replica = recommendations_replica()
+        if replica:
+            recommendations = replica.newest(limit, authorities=[authority] if authority else None)
+            return jsonify({"recommendations": recommendations})
+
         query = db.collection("recommendations").where("approved", "==", True)
         
         if authority:
@@ -1804,13 +2095,35 @@ def api_recommendations_latest():
         return jsonify({"error": str(e)}), 500
 
 
+@routes_bp.route('/api/grading-rules', methods=['GET'])
+@public
+def api_grading_rules():
+    """
+    Public API endpoint: the CPE grading rule table (core.grading_rules),
+    loaded by the n8n auto-grade workflow so both graders apply the same rules.
+    """
+    return jsonify(GRADING_RULES)
+
+
 @routes_bp.route('/api/events/latest', methods=['GET'])
+@public
+@conditional_feed('events')
 def api_events_latest():
     """
     Public API endpoint: Get latest upcoming events.
+    ?mode=upcoming returns events from today onwards, soonest first, with a
+    next_cursor for ?after=; the default mode=latest returns the newest added.
     """
     try:
         limit = int(request.args.get('limit', 20))
+
+        if request.args.get('mode') == 'upcoming':
+            events, next_cursor = _upcoming_events_page(limit, request.args.get('after') or None)
+            return jsonify({"events": events, "next_cursor": next_cursor})
+
+        replica = events_replica()
+        if replica:
+            return jsonify({"events": replica.newest(limit)})
         
         query = db.collection("events").order_by("created_at", direction=firestore.Query.DESCENDING).limit(limit)
         
@@ -1852,52 +2165,164 @@ def recommendations_page():
         if authority:
             authorities.add(authority)
     
-    # Fetch recommendations
+    # Fetch a full page of recommendations matching the user's authorities
+    page_size = 50
+    after = request.args.get('after')
+    sort = request.args.get('sort', 'relevance')
     try:
-        query = db.collection("recommendations").where("approved", "==", True).order_by("created_at", direction=firestore.Query.DESCENDING).limit(50)
-        
-        docs = query.stream()
-        all_recommendations = []
-        
-        for doc in docs:
-            rec = doc.to_dict()
-            rec['id'] = doc.id
-            
-            # Filter by user's authorities
-            rec_authorities = set(rec.get("authority_tags", []))
-            if authorities and rec_authorities.intersection(authorities):
-                all_recommendations.append(rec)
-            elif not authorities:  # Show all if user has no certs
-                all_recommendations.append(rec)
-        
-        return render_template('recommendations.html', recommendations=all_recommendations, user_authorities=list(authorities))
+        replica = recommendations_replica()
+
+        if sort == 'relevance' and authorities:
+            # Precomputed top-K, cached until the user's activities/certs or
+            # the recommendation corpus change
+            def load_ranking_inputs():
+                if replica:
+                    corpus = replica.newest()
+                else:
+                    corpus, _ = get_approved_recommendations(authorities, limit=RANKING_POOL_SIZE)
+                allowed_types = {a: r.get("activity_types") for a, r in AUTHORITY_ACTIVITY_RULES.items()}
+                return corpus, build_recommendation_gaps(uid, user_certs), allowed_types
+
+            # The query corpus is filtered by this user's authorities, so
+            # they are part of its version; the replica corpus is unfiltered
+            corpus_version = (
+                f"replica-{replica.version}" if replica
+                else f"query-{int(time.time() // RANKING_QUERY_TTL)}-{','.join(sorted(authorities))}"
+            )
+            ranked = get_ranked_recommendations(
+                uid, (g.user or {}).get('ranking_version', 0), corpus_version, load_ranking_inputs,
+                k=page_size
+            )
+            # Scored items lead the first page; the newest of the rest fill it
+            # and the following pages, so users with no open gaps still see items
+            page = [] if after else ranked
+            ranked_ids = {r['id'] for r in ranked}
+            start = None if after == RANKED_TAIL_CURSOR else after
+            if len(page) < page_size:
+                filler, next_cursor = _newest_recommendations_page(
+                    replica, authorities, page_size - len(page), start, exclude=ranked_ids
+                )
+            else:
+                # Ranked items fill the page; the unranked tail starts from the newest
+                filler = []
+                tail, _ = _newest_recommendations_page(replica, authorities, 1, exclude=ranked_ids)
+                next_cursor = RANKED_TAIL_CURSOR if tail else None
+            return render_template(
+                'recommendations.html',
+                recommendations=page + filler,
+                user_authorities=list(authorities),
+                next_cursor=next_cursor,
+                sort='relevance'
+            )
+
+        all_recommendations, next_cursor = _newest_recommendations_page(replica, authorities, page_size, after)
+
+        return render_template(
+            'recommendations.html',
+            recommendations=all_recommendations,
+            user_authorities=list(authorities),
+            next_cursor=next_cursor,
+            sort='newest'
+        )
     
     except Exception as e:
         current_app.logger.error(f"Error loading recommendations: {e}")
         flash("Error loading recommendations. Please try again.", "danger")
-        return render_template('recommendations.html', recommendations=[], user_authorities=[])
+        return render_template('recommendations.html', recommendations=[], user_authorities=[], sort=sort)
 
 
+def _newest_recommendations_page(replica, authorities, limit, start_after_id=None, exclude=()):
+    """
+    Newest approved recommendations for the authorities (all when empty),
+    skipping ids in `exclude`; returns (recommendations, next_cursor).
+    """
+    results, cursor = [], start_after_id
+    while len(results) < limit:
+        if replica:
+            # Served from memory through the authority_tags index
+            batch = replica.newest(limit, authorities=authorities or None, start_after_id=cursor)
+            more = len(batch) == limit
+        else:
+            # Filter runs in Firestore, so the page is always full when matches exist
+            batch, more = get_approved_recommendations(authorities or None, limit=limit, start_after_id=cursor)
+        for rec in batch:
+            cursor = rec['id']
+            if rec['id'] in exclude:
+                continue
+            results.append(rec)
+            if len(results) == limit:
+                return results, cursor
+        if not more:
+            return results, None
+    return results, cursor
+
+
+def _upcoming_events_page(limit, start_after_id=None):
+    """Events from the start of today (UTC), soonest first; returns (events, next_cursor)."""
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    replica = events_replica()
+    if replica:
+        events = replica.upcoming(today, limit, start_after_id)
+        return events, (events[-1]['id'] if len(events) == limit else None)
+    return get_upcoming_events(limit, start_after_id, today=today.replace(tzinfo=None))
+
+@routes_bp.route('/events.ics', methods=['GET'], endpoint='events_ics')
+@public
+# Calendar services poll from a few shared IPs; cached/304 responses are cheap
+@limiter.limit('1000 per hour')
+@conditional_feed('events')
+def events_ics():
+    """
+    Public iCalendar feed of upcoming events for calendar subscriptions.
+    ?authority=ISC2 limits it to events tagged for one known authority. The
+    body is rebuilt only when the events collection changes (see
+    core.calendar_feed); unchanged polls get 304 from conditional_feed.
+    """
+    authority = normalize_authority(request.args.get('authority')) or None
+    if authority and authority not in AUTHORITY_ACTIVITY_RULES:
+        return jsonify({'error': 'unknown authority', 'authorities': list(AUTHORITY_ACTIVITY_RULES)}), 400
+    # The version conditional_feed derived its ETag from, so the cached
+    # body always matches the ETag it is served under
+    version = g.get('feed_version')
+    body = get_calendar_feed(
+        authority, version, lambda: _upcoming_events_page(MAX_FEED_EVENTS)[0]
+    )
+    response = make_response(body)
+    response.mimetype = 'text/calendar'
+    filename = f"credpoint-events-{authority.lower()}.ics" if authority else 'credpoint-events.ics'
+    response.headers['Content-Disposition'] = f'inline; filename="{secure_filename(filename)}"'
+    return response
+
 @routes_bp.route('/events', methods=['GET'], endpoint='events_page')
 @firebase_required
+@conditional_feed('events', per_user=True)
 def events_page():
     """
-    Display all upcoming cybersecurity events.
+    Display all upcoming cybersecurity events, soonest first, a page at a
+    time (`after` cursor). ?mode=latest lists the most recently added instead.
     """
+    mode = request.args.get('mode', 'upcoming')
     try:
-        query = db.collection("events").order_by("created_at", direction=firestore.Query.DESCENDING).limit(50)
-        
-        docs = query.stream()
-        events = []
-        
-        for doc in docs:
-            evt = doc.to_dict()
-            evt['id'] = doc.id
-            events.append(evt)
-        
-        return render_template('events.html', events=events)
+        next_cursor = None
+        replica = events_replica()
+        if mode == 'upcoming':
+            events, next_cursor = _upcoming_events_page(EVENTS_PAGE_SIZE, request.args.get('after') or None)
+        elif replica:
+            events = replica.newest(EVENTS_PAGE_SIZE)
+        else:
+            query = db.collection("events").order_by("created_at", direction=firestore.Query.DESCENDING).limit(EVENTS_PAGE_SIZE)
+            events = [{**doc.to_dict(), 'id': doc.id} for doc in query.stream()]
+
+        for evt in events:
+            ev_date = evt.get('date')
+            if isinstance(ev_date, (datetime, date)):
+                evt['date_display'] = ev_date.strftime('%Y-%m-%d')
+            else:
+                evt['date_display'] = str(ev_date or '')[:10]
+
+        return render_template('events.html', events=events, mode=mode, next_cursor=next_cursor)
     
     except Exception as e:
         current_app.logger.error(f"Error loading events: {e}")
         flash("Error loading events. Please try again.", "danger")
-        return render_template('events.html', events=[])
+        return render_template('events.html', events=[], mode=mode, next_cursor=None)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmark rate-limiter overhead per request for each storage backend.
+
+Each simulated request hits the default limits (RATE_LIMIT_DEFAULT, two
+fixed windows) through the same limits strategy Flask-Limiter uses, from
+several threads in several forked worker processes at once.
+
+    python scripts/bench_rate_limit.py --workers 4 --threads 8 --requests 2000
+
+Reports microseconds per request and, for shared backends, whether the final
+counts match the number of hits (memory:// counts per worker, so it does not).
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from limits import parse_many, storage, strategies  # noqa: E402
+from core.rate_limit_storage import SQLiteStorage  # noqa: E402,F401  registers sqlite://
+
+LIMITS = os.environ.get('RATE_LIMIT_DEFAULT', '200 per day, 50 per hour')
+
+
+def _items():
+    # Same windows as the default limits, but high enough that every hit is counted
+    return [type(item)(10 ** 9, item.multiples) for item in parse_many(LIMITS)]
+
+
+def _worker(uri, threads, requests, keys, results):
+    limiter = strategies.FixedWindowRateLimiter(storage.storage_from_string(uri))
+    items = _items()
+
+    def run(n):
+        for i in range(requests):
+            key = f'10.0.{n}.{i % keys}'
+            for item in items:
+                limiter.hit(item, key)
+
+    pool = [threading.Thread(target=run, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    results.put(time.perf_counter() - start)
+
+
+def bench(uri, workers, threads, requests, keys):
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_worker, args=(uri, threads, requests, keys, results)) for _ in range(workers)]
+    start = time.perf_counter()
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    wall = time.perf_counter() - start
+    # Each worker's threads run concurrently, so elapsed / requests is the
+    # time one request spends in the limiter (including lock waits)
+    elapsed = sum(results.get() for _ in procs) / workers
+
+    total = workers * threads * requests
+    counted = None
+    if not uri.startswith('memory'):
+        check = storage.storage_from_string(uri)
+        limiter = strategies.FixedWindowRateLimiter(check)
+        item = _items()[0]
+        counted = sum(
+            10 ** 9 - limiter.get_window_stats(item, f'10.0.{n}.{k}').remaining
+            for n in range(threads) for k in range(keys)
+        )
+        check.reset()
+    return {
+        'requests': total,
+        'us_per_request': elapsed / requests * 1e6,
+        'throughput': total / wall,
+        'counted': counted,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=4, help='forked worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='threads per worker')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per thread')
+    parser.add_argument('--keys', type=int, default=50, help='distinct client keys per thread')
+    parser.add_argument('--storage', action='append',
+                        help='storage URI to benchmark (repeatable; default memory:// and sqlite://)')
+    args = parser.parse_args()
+
+    uris = args.storage or ['memory://', 'sqlite://' + os.path.join(tempfile.gettempdir(), 'bench-ratelimits.db')]
+    print(f'{args.workers} workers x {args.threads} threads x {args.requests} requests, limits: {LIMITS}')
+    for uri in uris:
+        r = bench(uri, args.workers, args.threads, args.requests, args.keys)
+        counted = 'per-worker' if r['counted'] is None else f"{r['counted']}/{r['requests']}"
+        print(f"{uri:45} {r['us_per_request']:8.1f} us/request  {r['throughput']:10.0f} req/s  counted {counted}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,192 @@
-from flask import session, redirect, url_for, g
+from flask import session, redirect, url_for, g, request, make_response, jsonify
+from firebase_admin import auth
 from functools import wraps
-from services.models import get_user  # import your get_user function
-
-def firebase_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        if 'uid' not in session:
-            return redirect(url_for('routes.login_page'))
-
-        g.uid = session['uid']
-        user_data = get_user(g.uid)
-
-        if not user_data:
-            # User record missing, maybe log them out or redirect
-            return redirect(url_for('routes.login_page'))
-
-        g.user = user_data
-        return f(*args, **kwargs)
-    return decorated
-
-
-def admin_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        # Ensure user is logged in
-        if 'uid' not in session:
-            return redirect(url_for('routes.login_page'))
-
-        g.uid = session['uid']
-        user_data = get_user(g.uid)
-        if not user_data:
-            return redirect(url_for('routes.login_page'))
-
-        # Accept either explicit is_admin flag or role == 'admin'
-        if not user_data.get('is_admin') and user_data.get('role') != 'admin':
-            # not authorized
-            return redirect(url_for('routes.dashboard_page'))
-
-        g.user = user_data
-        return f(*args, **kwargs)
-    return decorated
+from datetime import date
+import gzip
+import hashlib
+import hmac
+import os
+from core.auth_utils import SESSION_COOKIE_MODE, SESSION_COOKIE_NAME, verify_firebase_session_cookie
+from services.models import get_user, get_collection_version  # import your get_user function
+from services.replica import events_replica, recommendations_replica
+
+GZIP_MIN_SIZE = 1024  # bytes; smaller JSON bodies are sent as-is
+
+# =====================
+# Per-endpoint auth policies
+# =====================
+# Every view declares how it is authenticated and app.before_request runs
+# exactly that one check (enforce_auth_policy). Views without a declaration
+# are treated as 'session'.
+#   public   no auth work at all
+#   session  signed-in user; sets g.uid and g.user (the Firestore profile)
+#   admin    as session, and the profile must be an admin
+#   webhook  shared secret in a request header, for machine callers
+_STRICTNESS = {'public': 0, 'webhook': 1, 'session': 2, 'admin': 3}
+
+
+def auth_policy(kind, **options):
+    """Declare a view's auth policy; stacked declarations keep the strictest."""
+    if kind not in _STRICTNESS:
+        raise ValueError(f"Unknown auth policy: {kind}")
+
+    def decorator(f):
+        current = getattr(f, 'auth_policy', None)
+        if current is None or _STRICTNESS[kind] > _STRICTNESS[current[0]]:
+            f.auth_policy = (kind, options)
+        return f
+    return decorator
+
+
+public = auth_policy('public')
+firebase_required = auth_policy('session')
+admin_required = auth_policy('admin')
+
+
+def webhook(token_env, header='X-Webhook-Token'):
+    """Require the `header` request header to match the `token_env` secret."""
+    return auth_policy('webhook', token_env=token_env, header=header)
+
+
+def _signed_in_uid():
+    """uid from the Firebase session cookie or the session's ID token, else None."""
+    if SESSION_COOKIE_MODE:
+        claims = verify_firebase_session_cookie(request.cookies.get(SESSION_COOKIE_NAME))
+        return claims.get('uid') if claims else None
+
+    id_token = session.get('firebase_id_token')
+    if not id_token:
+        return None
+    try:
+        return auth.verify_id_token(id_token).get('uid')
+    except Exception:
+        return None
+
+
+def enforce_auth_policy(view):
+    """Run the auth check declared for `view`; returns a response to short-circuit."""
+    kind, options = getattr(view, 'auth_policy', ('session', {}))
+    if kind == 'public':
+        return None
+
+    if kind == 'webhook':
+        expected = os.environ.get(options['token_env'])
+        supplied = request.headers.get(options['header'], '')
+        if not expected or not hmac.compare_digest(supplied, expected):
+            return jsonify({'success': False, 'error': 'unauthorized'}), 401
+        return None
+
+    uid = _signed_in_uid()
+    if not uid:
+        session.clear()
+        return redirect(url_for('routes.login_page'))
+    if session.get('uid') != uid:
+        # Flask session lapsed (or changed user) while the login is still valid
+        session.permanent = True
+        session['uid'] = uid
+
+    user_data = get_user(uid)
+    if not user_data:
+        # User record missing, maybe log them out or redirect
+        return redirect(url_for('routes.login_page'))
+
+    # Accept either explicit is_admin flag or role == 'admin'
+    if kind == 'admin' and not user_data.get('is_admin') and user_data.get('role') != 'admin':
+        return redirect(url_for('routes.dashboard_page'))
+
+    g.uid = uid
+    g.user = user_data
+    return None
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified and request.if_modified_since:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def _gzip_json(response):
+    response.vary.add('Accept-Encoding')
+    if (response.mimetype != 'application/json' or response.direct_passthrough
+            or 'gzip' not in request.accept_encodings):
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+_FEED_REPLICAS = {'events': events_replica, 'recommendations': recommendations_replica}
+
+
+def feed_version(collection):
+    """
+    (version, last_modified) of the data a feed of `collection` is built from.
+    Routes serve these collections from the live replica when it is ready,
+    and the replica can lag the Firestore version doc, so its own content
+    fingerprint is used then; otherwise the collection version.
+    """
+    accessor = _FEED_REPLICAS.get(collection)
+    replica = accessor() if accessor else None
+    if replica:
+        key, last_modified = replica.fingerprint()
+        return f"replica-{key}", last_modified
+    return get_collection_version(collection)
+
+
+def conditional_feed(collection, per_user=False):
+    """
+    Answer GETs of a feed built from a global collection conditionally.
+
+    The ETag is derived from the version of the data the view reads (see
+    feed_version; also left in g.feed_version for the view), the URL with
+    its query string, the current
+    date (past events drop out of the lists without a write) and, for
+    per_user pages, the signed-in user. A matching If-None-Match or
+    If-Modified-Since returns 304 before the view runs, so no query is made.
+    JSON responses are gzipped when the client accepts it. per_user feeds
+    need a session or admin auth policy so g.uid is set.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if '_flashes' in session:
+                # Pending flash messages are rendered into this response only
+                return f(*args, **kwargs)
+            try:
+                version, last_modified = feed_version(collection)
+                g.feed_version = version
+            except Exception:
+                return _gzip_json(make_response(f(*args, **kwargs)))
+
+            key = [collection, str(version), request.full_path, date.today().isoformat()]
+            if per_user:
+                key.append(g.uid)
+            etag = hashlib.sha1('|'.join(key).encode()).hexdigest()
+
+            if _not_modified(etag, last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                response = _gzip_json(response)
+
+            # Weak: the same ETag covers the gzipped and identity encodings
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            if per_user:
+                response.cache_control.private = True
+                response.vary.add('Cookie')
+            else:
+                response.cache_control.public = True
+            response.vary.add('Accept-Encoding')
+            return response
+        return decorated
+    return decorator
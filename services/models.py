@@ -1,7 +1,9 @@
 from .firebase_config import db
-from datetime import datetime, date
+from datetime import datetime, date, timedelta, timezone
+import time
 from firebase_admin import firestore 
 from google.cloud.firestore import FieldFilter
+from google.api_core.exceptions import NotFound
 from flask import g
 # ========================
 
@@ -33,14 +35,37 @@ def _recalculate_certificate_earned_cpes(uid, cert_id):
             'progress_percentage': progress
         }, merge=True)
 
-def _recalc_user_credits(uid):
-    """Recompute total credits from all activities and write to user document."""
-    acts = db.collection('users').document(uid).collection('activities').stream()
-    total = sum(float(a.to_dict().get('cpe_points') or 0) for a in acts)
+def _apply_credit_delta(uid, delta):
+    """Add a cpe_points change to the user's credits without rescanning activities."""
+    if not delta:
+        return
+    # merge-set with an increment also works when the user doc has no credits yet
+    db.collection('users').document(uid).set({'credits': firestore.Increment(delta)}, merge=True)
+
+
+def recompute_user_credits(uid):
+    """
+    Repair path for the incremental credit updates: rescan the user's
+    activities, overwrite `credits` with their cpe_points total and re-sum
+    every certificate. An increment landing mid-scan can be lost, so run it
+    off-peak (`flask recompute-credits`). Returns the new total.
+    """
+    user_ref = db.collection('users').document(uid)
+    acts = user_ref.collection('activities').select(['cpe_points']).stream()
+    total = sum(float((a.to_dict() or {}).get('cpe_points') or 0) for a in acts)
+    user_ref.set({'credits': total}, merge=True)
+    for cert in user_ref.collection('certificates').select([]).stream():
+        _recalculate_certificate_earned_cpes(uid, cert.id)
+    return total
+
+
+def _bump_ranking_version(uid):
+    """Invalidate cached recommendation rankings after activities/certs change."""
     try:
-        db.collection('users').document(uid).update({'credits': total})
+        db.collection('users').document(uid).update({'ranking_version': firestore.Increment(1)})
     except Exception:
-        db.collection('users').document(uid).set({'credits': total}, merge=True)
+        # best-effort: ranking falls back to its other cache keys
+        pass
 
 
 # ========================
@@ -59,6 +84,25 @@ def update_user(uid, updates):
     db.collection("users").document(uid).update(updates)
 
 
+def iter_user_pages(page_size=200, start_after_uid=None, fields=('name', 'full_name', 'email')):
+    """
+    Yield pages of users ordered by document id, reading only `fields`.
+    Each page is a list of dicts with 'uid' plus the selected fields.
+    """
+    last = start_after_uid
+    while True:
+        q = db.collection("users").select(list(fields)).order_by("__name__").limit(page_size)
+        if last:
+            q = q.start_after({"__name__": db.collection("users").document(last)})
+        page = [{**(d.to_dict() or {}), "uid": d.id} for d in q.stream()]
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last = page[-1]["uid"]
+
+
 # ========================
 # ACTIVITIES COLLECTION (per user)
 # ========================
@@ -120,17 +164,14 @@ def create_activity(uid, data):
 
     # Update user credits only if award points are being awarded
     if cpe_total > 0:
-        user_ref = db.collection('users').document(uid)
-        try:
-            user_ref.update({'credits': firestore.Increment(cpe_total)})
-        except Exception:
-            _recalc_user_credits(uid)
+        _apply_credit_delta(uid, cpe_total)
     
     # For legacy model: if linked to a certificate, recalc that certificate totals
     cert_id = data.get('certification_id')
     if cert_id:
         _recalculate_certificate_earned_cpes(uid, cert_id)
 
+    _bump_ranking_version(uid)
     return ref.id
     if cert_id:
         _recalculate_certificate_earned_cpes(uid, cert_id)
@@ -146,6 +187,25 @@ def get_user_activities(uid):
         activities.append(a)
     return activities
 
+def get_activities_to_verify(uid, since):
+    """
+    Activities that need grading: drafts and pending ones, plus any changed
+    after `since` (the user's verification watermark). An activity whose
+    last change was its own grading (graded_at == updated_at) is skipped.
+    Both queries use single-field indexes.
+    """
+    acts = db.collection("users").document(uid).collection("activities")
+    selected = {}
+    for doc in acts.where(filter=FieldFilter('status', 'in', ['draft', 'pending'])).stream():
+        selected[doc.id] = {**doc.to_dict(), 'id': doc.id}
+
+    for doc in acts.where(filter=FieldFilter('updated_at', '>', since)).stream():
+        a = doc.to_dict()
+        if doc.id in selected or (a.get('graded_at') and a.get('graded_at') == a.get('updated_at')):
+            continue
+        selected[doc.id] = {**a, 'id': doc.id}
+    return list(selected.values())
+
 def update_activity(uid, activity_id, data):
     """
     Update an activity doc, adjust user credits by delta, and recalc affected certificates.
@@ -173,19 +233,14 @@ def update_activity(uid, activity_id, data):
     else:
         new_cpe = old_cpe
 
-    # add updated_at
-    data['updated_at'] = datetime.utcnow()
+    # add updated_at (callers may pin it, e.g. to match graded_at)
+    data.setdefault('updated_at', datetime.utcnow())
 
     # perform update
     activity_ref.update(data)
 
-    # update user's credits by the delta (atomic increment when possible)
-    delta = new_cpe - old_cpe
-    if delta != 0:
-        try:
-            db.collection('users').document(uid).update({'credits': firestore.Increment(delta)})
-        except Exception:
-            _recalc_user_credits(uid)
+    # update user's credits by the delta (atomic increment)
+    _apply_credit_delta(uid, new_cpe - old_cpe)
 
     # recalc any affected certificates (old and new)
     new_cert = data.get('certification_id') or old_cert
@@ -193,9 +248,135 @@ def update_activity(uid, activity_id, data):
     for cert_id in affected:
         _recalculate_certificate_earned_cpes(uid, cert_id)
 
+    _bump_ranking_version(uid)
+
     # keep API parity (no explicit return)
     return
 
+def get_activity(uid, activity_id):
+    doc = db.collection("users").document(uid).collection("activities").document(str(activity_id)).get()
+    if not doc.exists:
+        return None
+    a = doc.to_dict()
+    a['id'] = doc.id
+    return a
+
+def _pending_activities_query():
+    return db.collection_group('activities').where(filter=FieldFilter('status', '==', 'pending'))
+
+def get_pending_activities_page(limit=50, start_after_path=None):
+    """
+    Oldest-first page of pending activities across all users.
+    Requires the [status ASC, submitted_at ASC] collection-group index.
+    `start_after_path` is the document path of the last activity on the
+    previous page. Returns (activities, next_cursor); each activity carries
+    activity_id and user_id.
+    """
+    q = _pending_activities_query().order_by('submitted_at').limit(limit)
+    if start_after_path:
+        cursor = db.document(start_after_path).get()
+        if cursor.exists:
+            q = q.start_after(cursor)
+
+    docs = list(q.stream())
+    activities = []
+    for doc in docs:
+        a = doc.to_dict()
+        # users/{uid}/activities/{activity_id}
+        parent = doc.reference.parent.parent
+        a['activity_id'] = doc.id
+        a['user_id'] = parent.id if parent is not None else None
+        activities.append(a)
+    next_cursor = docs[-1].reference.path if len(docs) == limit else None
+    return activities, next_cursor
+
+def attach_owner_context(activities):
+    """
+    Add user_name, user_email and cert_name to rows that carry user_id (and
+    optionally certification_id), resolving every distinct user and
+    certificate document in a single db.get_all() round trip.
+    """
+    refs = {}
+    for a in activities:
+        uid = a.get('user_id')
+        if not uid:
+            continue
+        user_ref = db.collection("users").document(uid)
+        refs[user_ref.path] = user_ref
+        if a.get('certification_id'):
+            cert_ref = user_ref.collection("certificates").document(str(a['certification_id']))
+            refs[cert_ref.path] = cert_ref
+
+    docs = {}
+    if refs:
+        for snap in db.get_all(list(refs.values()), field_paths=['name', 'full_name', 'email']):
+            if snap.exists:
+                docs[snap.reference.path] = snap.to_dict() or {}
+
+    for a in activities:
+        uid = a.get('user_id')
+        user = docs.get(f"users/{uid}", {}) if uid else {}
+        a['user_name'] = user.get('full_name') or user.get('name')
+        a['user_email'] = user.get('email')
+        cert = docs.get(f"users/{uid}/certificates/{a.get('certification_id')}", {}) if uid else {}
+        a['cert_name'] = cert.get('name')
+    return activities
+
+def count_pending_activities():
+    """Number of pending activities, from a count aggregation (no documents read)."""
+    result = _pending_activities_query().count(alias='total').get()
+    return int(result[0][0].value)
+
+def set_activity_proof_status(uid, activity_id, status, proof_file=None):
+    """
+    Record the outcome of a background proof upload.
+    Returns False if the activity was deleted in the meantime.
+    """
+    data = {'proof_status': status}
+    if proof_file:
+        data['proof_file'] = proof_file
+    try:
+        db.collection("users").document(uid).collection("activities").document(str(activity_id)).update(data)
+    except NotFound:
+        return False
+    return True
+
+def fail_stale_proof_uploads(older_than):
+    """
+    Mark activities stuck in proof_status 'uploading' since before
+    `older_than` as 'failed' (the worker running the upload died, and its
+    spooled file with it). Returns the number of activities updated.
+    """
+    stale = [
+        doc.reference for doc in db.collection_group("activities")
+                                   .where(filter=FieldFilter('proof_status', '==', 'uploading')).stream()
+        if _is_expired(doc.to_dict().get('created_at'), older_than)
+    ]
+    written, _ = _commit_in_chunks([[('update', ref, {'proof_status': 'failed'})] for ref in stale])
+    return written
+
+@firestore.transactional
+def _set_derivatives_txn(transaction, ref, source_field, source, field, paths):
+    snap = ref.get(transaction=transaction)
+    if not snap.exists or (snap.to_dict() or {}).get(source_field) != source:
+        # Deleted, or a newer upload replaced the file these were rendered from
+        return False
+    transaction.update(ref, {field: paths})
+    return True
+
+def set_activity_proof_derivatives(uid, activity_id, proof_file, paths):
+    """
+    Record the thumbnail paths rendered for `proof_file`, unless the activity
+    has moved on to another proof since. Returns True if they were written.
+    """
+    ref = db.collection("users").document(uid).collection("activities").document(str(activity_id))
+    return _set_derivatives_txn(db.transaction(), ref, 'proof_file', proof_file, 'proof_derivatives', paths)
+
+def set_profile_image_derivatives(uid, profile_image, paths):
+    """Record the avatar paths rendered for `profile_image` if it is still the user's image."""
+    ref = db.collection('users').document(uid)
+    return _set_derivatives_txn(db.transaction(), ref, 'profile_image', profile_image, 'profile_image_derivatives', paths)
+
 def delete_activity(uid, activity_id):
     user_ref = db.collection("users").document(uid)
     activity_ref = user_ref.collection("activities").document(activity_id)
@@ -214,8 +395,12 @@ def delete_activity(uid, activity_id):
         if cert_id:
             _recalculate_certificate_earned_cpes(uid, cert_id)
 
-        # Recalculate overall user credits
-        _recalc_user_credits(uid)
+        # Take this activity's points off the user's credits
+        _apply_credit_delta(uid, -cpe_points)
+
+        # Drop this activity's reference to its (possibly shared) proof file
+        release_proof_blob(uid, activity_data.get("proof_file"))
+        _bump_ranking_version(uid)
 
     else:
         # No activity found, just exit
@@ -229,6 +414,7 @@ def create_certificate(uid, data):
     data['created_at'] = datetime.utcnow()
     ref = db.collection("users").document(uid).collection("certificates").document()
     ref.set(data)
+    _bump_ranking_version(uid)
     return ref.id
 
 def get_user_certificates(uid):
@@ -297,10 +483,12 @@ def update_certificate(uid, cert_id, data):
         except ValueError:
             data['renewal_date'] = None
     cert_ref.update(data)
+    _bump_ranking_version(uid)
 
 def delete_certificate(uid, cert_id):
     cert_ref = db.collection("users").document(uid).collection("certificates").document(cert_id)
     cert_ref.delete()
+    _bump_ranking_version(uid)
 
 
 # ========================
@@ -313,8 +501,11 @@ def create_recommendation(uid, data):
     return ref.id
 
 def get_user_recommendations(uid):
+    """Recommendations for a user, without expired ones (removed by the sweeper)."""
+    now = datetime.utcnow()
     docs = db.collection("users").document(uid).collection("recommendations").stream()
-    return [doc.to_dict() | {'id': doc.id} for doc in docs]
+    recs = [doc.to_dict() | {'id': doc.id} for doc in docs]
+    return [r for r in recs if not _is_expired(r.get("expires_at"), now)]
 
 def recommendation_to_dict(form, created_by_uid):
     return {
@@ -325,6 +516,32 @@ def recommendation_to_dict(form, created_by_uid):
         "created_by_uid": created_by_uid
     }
 
+# ========================
+# APPROVED RECOMMENDATIONS (global)
+# ========================
+def get_approved_recommendations(authorities=None, limit=50, start_after_id=None):
+    """
+    Newest approved recommendations, optionally only those tagged with any of
+    `authorities`. The authority filter runs in Firestore (array_contains_any),
+    so every document read is one that is returned.
+    Requires the [approved ASC, authority_tags CONTAINS, created_at DESC] index.
+    Returns (recommendations, next_cursor); next_cursor is None on the last page.
+    """
+    q = db.collection("recommendations").where(filter=FieldFilter("approved", "==", True))
+    if authorities:
+        # Firestore accepts at most 30 values in an array_contains_any filter
+        q = q.where(filter=FieldFilter("authority_tags", "array_contains_any", list(authorities)[:30]))
+    q = q.order_by("created_at", direction=firestore.Query.DESCENDING).limit(limit)
+
+    if start_after_id:
+        cursor = db.collection("recommendations").document(start_after_id).get()
+        if cursor.exists:
+            q = q.start_after(cursor)
+
+    recs = [{**d.to_dict(), "id": d.id} for d in q.stream()]
+    next_cursor = recs[-1]["id"] if len(recs) == limit else None
+    return recs, next_cursor
+
 # ========================
 # VERIFICATIONS COLLECTION (per user)
 # ========================
@@ -334,10 +551,359 @@ def create_verification(uid, data):
     ref.set(data)
     return ref.id
 
+def verification_doc_id(activity_id):
+    """Deterministic id of an activity's verification record."""
+    return f"activity_{activity_id}"
+
+def set_verification(uid, activity_id, data):
+    """Create or overwrite the verification record for an activity."""
+    data['created_at'] = datetime.utcnow()
+    ref = db.collection("users").document(uid).collection("verifications") \
+            .document(verification_doc_id(activity_id))
+    ref.set(data)
+    return ref.id
+
+WRITE_BATCH_LIMIT = 500  # operations per Firestore WriteBatch
+
+def _commit_batch(ops):
+    batch = db.batch()
+    for kind, ref, data in ops:
+        getattr(batch, kind)(ref, data)
+    batch.commit()
+
+def _commit_in_chunks(groups):
+    """
+    Apply groups of (kind, ref, data) write ops with chunked WriteBatch
+    commits. A group (e.g. an activity update and its verification record)
+    is never split across batches, so it is written entirely or not at all.
+    A chunk that fails as a whole (e.g. an activity deleted mid-run makes
+    its update fail) is retried group by group.
+    Returns (written, failed_paths) with the paths of every op in failed groups.
+    """
+    written = 0
+    failed = []
+    chunks, chunk, size = [], [], 0
+    for group in filter(None, groups):
+        if chunk and size + len(group) > WRITE_BATCH_LIMIT:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(group)
+        size += len(group)
+    if chunk:
+        chunks.append(chunk)
+
+    for chunk in chunks:
+        try:
+            _commit_batch([op for group in chunk for op in group])
+            written += sum(len(group) for group in chunk)
+            continue
+        except Exception:
+            pass
+        for group in chunk:
+            try:
+                _commit_batch(group)
+                written += len(group)
+            except Exception:
+                failed.extend(ref.path for _, ref, _ in group)
+    return written, failed
+
+def commit_verification_run(uid, verifications, approvals, cert_ids=(), watermark=None, throttle=None):
+    """
+    Persist one grading run for a user in batched writes.
+
+    verifications: {activity_id: verification record}
+    approvals: {activity_id: fields to update on the activity}
+    The ranking version is bumped once at the end instead of per activity.
+    Credits and certificate totals sum cpe_points, so `cert_ids` are only
+    re-summed when an approval changes cpe_points (grading sets awarded_cpe,
+    so normally they are skipped).
+    `watermark`, if given, is stored as the user's verification_watermark,
+    but only when every activity was written, so failed ones are re-graded.
+    `throttle(n)`, if given, is called with the number of document writes
+    (including the recomputed totals) before they are sent.
+    Returns (written, failed activities).
+    """
+    user_ref = db.collection("users").document(uid)
+    now = datetime.utcnow()
+    groups = []
+    for activity_id, record in verifications.items():
+        # The activity update (if any) and its record commit together
+        group = []
+        if activity_id in approvals:
+            group.append(('update', user_ref.collection("activities").document(str(activity_id)),
+                          approvals[activity_id]))
+        ref = user_ref.collection("verifications").document(verification_doc_id(activity_id))
+        group.append(('set', ref, {**record, 'created_at': now}))
+        groups.append(group)
+    for activity_id, fields in approvals.items():
+        if activity_id not in verifications:
+            groups.append([('update', user_ref.collection("activities").document(str(activity_id)), fields)])
+    # Certificate totals only move when cpe_points does (delta zero otherwise)
+    cpe_changed = any('cpe_points' in fields for fields in approvals.values())
+    cert_ids = set(filter(None, cert_ids)) if cpe_changed else set()
+
+    if throttle:
+        totals = len(cert_ids) + bool(approvals)  # certificates, ranking version
+        throttle(sum(len(group) for group in groups) + (watermark is not None) + totals)
+
+    written, failed_paths = _commit_in_chunks(groups)
+    failed = {path.rsplit('/', 1)[-1] for path in failed_paths if '/activities/' in path}
+    failed |= {path.rsplit('/', 1)[-1][len(verification_doc_id('')):]
+               for path in failed_paths if '/verifications/' in path}
+
+    if watermark is not None and not failed:
+        w, _ = _commit_in_chunks([[('update', user_ref, {'verification_watermark': watermark})]])
+        written += w
+
+    for cert_id in cert_ids:
+        _recalculate_certificate_earned_cpes(uid, cert_id)
+    if approvals:
+        _bump_ranking_version(uid)
+    return written, len(failed)
+
+def review_activities_bulk(reviewer_uid, decisions):
+    """
+    Apply admin approve/reject decisions in batched writes.
+
+    decisions: dicts with user_id, activity_id, status ('approved' or
+    'rejected'), awarded_cpe (approvals only) and reason. Each decision
+    updates the activity and overwrites its verification record in the same
+    batch; every affected user's ranking version is bumped once. The
+    activity is stamped graded_at == updated_at so verification runs treat
+    the admin decision as graded rather than as a user change.
+    Returns (done, failed) lists of (user_id, activity_id).
+    """
+    now = datetime.utcnow()
+    groups = []
+    users = set()
+    for d in decisions:
+        user_ref = db.collection("users").document(d['user_id'])
+        approved = d['status'] == 'approved'
+        awarded = d.get('awarded_cpe') if approved else None
+        activity_op = ('update', user_ref.collection("activities").document(str(d['activity_id'])), {
+            'status': d['status'],
+            'awarded_cpe': awarded,
+            'awarded_reason': d['reason'],
+            'awarded_by': reviewer_uid,
+            'updated_at': now,
+            'graded_at': now
+        })
+        record_op = ('set', user_ref.collection("verifications").document(verification_doc_id(d['activity_id'])), {
+            'activity_id': d['activity_id'],
+            'status': 'verified' if approved else 'rejected',
+            'user_id': d['user_id'],
+            'awarded_cpe': awarded,
+            'reason': d['reason'],
+            'auto_approved': False,
+            'verified_at': now,
+            'created_at': now
+        })
+        groups.append([activity_op, record_op])
+
+    _, failed_paths = _commit_in_chunks(groups)
+    failed_paths = set(failed_paths)
+    done, failed = [], []
+    for d in decisions:
+        path = f"users/{d['user_id']}/activities/{d['activity_id']}"
+        if path in failed_paths:
+            failed.append((d['user_id'], d['activity_id']))
+        else:
+            done.append((d['user_id'], d['activity_id']))
+            users.add(d['user_id'])
+
+    _commit_in_chunks([
+        [('update', db.collection("users").document(uid), {'ranking_version': firestore.Increment(1)})]
+        for uid in users
+    ])
+    return done, failed
+
 def get_user_verifications(uid):
     docs = db.collection("users").document(uid).collection("verifications").stream()
     return [doc.to_dict() | {'id': doc.id} for doc in docs]
 
+# ========================
+# JOB CHECKPOINTS (resumable batch jobs)
+# ========================
+def get_job_checkpoint(job_name):
+    doc = db.collection('jobs').document(job_name).get()
+    return doc.to_dict() if doc.exists else None
+
+def save_job_checkpoint(job_name, data):
+    data['updated_at'] = datetime.utcnow()
+    db.collection('jobs').document(job_name).set(data, merge=True)
+
+# Leased checkpoints: a run owns jobs/{job_name} while its lease is current,
+# so overlapping runs (a cron retry plus a manual run) cannot both take the
+# same page. A crashed run's lease expires and the next run takes over.
+JOB_LEASE_SECONDS = 900
+
+@firestore.transactional
+def _claim_job_txn(transaction, ref, owner, lease_seconds, restart):
+    snap = ref.get(transaction=transaction)
+    data = (snap.to_dict() or {}) if snap.exists else {}
+    now = datetime.utcnow()
+    holder = data.get('lease_owner')
+    if holder and holder != owner and not _is_expired(data.get('lease_until'), now):
+        return None
+    if restart or data.get('status') != 'running':
+        data = {'status': 'running', 'last_uid': None, 'counts': {}, 'failed_uids': [], 'retry_uids': None}
+    data.update(lease_owner=owner, lease_until=now + timedelta(seconds=lease_seconds), updated_at=now)
+    transaction.set(ref, data)
+    return data
+
+def claim_job_checkpoint(job_name, owner, lease_seconds=JOB_LEASE_SECONDS, restart=False):
+    """
+    Take (or renew) the lease on a job's checkpoint and return its state,
+    starting a new run when none is running or `restart` is set. Returns
+    None while another owner holds an unexpired lease.
+    """
+    ref = db.collection('jobs').document(job_name)
+    return _claim_job_txn(db.transaction(), ref, owner, lease_seconds, restart)
+
+@firestore.transactional
+def _commit_job_txn(transaction, ref, owner, data, release):
+    snap = ref.get(transaction=transaction)
+    if not snap.exists or (snap.to_dict() or {}).get('lease_owner') != owner:
+        return False
+    data = dict(data, updated_at=datetime.utcnow())
+    if release:
+        data.update(lease_owner=None, lease_until=None)
+    transaction.update(ref, data)
+    return True
+
+def commit_job_checkpoint(job_name, owner, data, release=False):
+    """
+    Save progress under the caller's lease (optionally releasing it).
+    Returns False if the lease was lost to another run; nothing is written.
+    """
+    ref = db.collection('jobs').document(job_name)
+    return _commit_job_txn(db.transaction(), ref, owner, data, release)
+
+
+# ========================
+# PROOF FILES (content-addressed, reference counted)
+# ========================
+def _proof_blob_ref(uid, sha256):
+    return db.collection('proof_blobs').document(f"{uid}_{sha256}")
+
+@firestore.transactional
+def _acquire_proof_blob_txn(transaction, ref):
+    snap = ref.get(transaction=transaction)
+    if not snap.exists or snap.to_dict().get('deleting_at'):
+        # Missing, or claimed by the sweep: the caller uploads the content again
+        return None
+    transaction.update(ref, {'ref_count': firestore.Increment(1), 'orphaned_at': None})
+    return snap.to_dict().get('blob_name')
+
+def acquire_proof_blob(uid, sha256):
+    """
+    Take a reference on an already stored proof with this content hash.
+    Returns the blob name, or None if the content has not been stored yet.
+    """
+    return _acquire_proof_blob_txn(db.transaction(), _proof_blob_ref(uid, sha256))
+
+@firestore.transactional
+def _register_proof_blob_txn(transaction, ref, data):
+    snap = ref.get(transaction=transaction)
+    if snap.exists and not snap.to_dict().get('deleting_at'):
+        # Another request stored the same content first; share its record
+        transaction.update(ref, {'ref_count': firestore.Increment(1), 'orphaned_at': None})
+        return snap.to_dict().get('blob_name')
+    transaction.set(ref, data)
+    return data['blob_name']
+
+def register_proof_blob(uid, upload):
+    """
+    Record a freshly uploaded proof (result dict from the upload pipeline)
+    with a reference count of one. Returns the blob name to store on the activity.
+    """
+    data = {
+        'uid': uid,
+        'sha256': upload['sha256'],
+        'blob_name': upload['blob_name'],
+        'generation': upload.get('generation'),
+        'size': upload.get('size'),
+        'content_type': upload.get('content_type'),
+        'ref_count': 1,
+        'orphaned_at': None,
+        'created_at': datetime.utcnow()
+    }
+    return _register_proof_blob_txn(db.transaction(), _proof_blob_ref(uid, upload['sha256']), data)
+
+@firestore.transactional
+def _release_proof_blob_txn(transaction, ref):
+    snap = ref.get(transaction=transaction)
+    if not snap.exists:
+        return
+    remaining = int(snap.to_dict().get('ref_count') or 0) - 1
+    if remaining > 0:
+        transaction.update(ref, {'ref_count': remaining})
+    else:
+        transaction.update(ref, {'ref_count': 0, 'orphaned_at': datetime.utcnow()})
+
+def release_proof_blob(uid, blob_name):
+    """
+    Drop one reference to a proof file. Blobs that reach zero references are
+    left in place for sweep_orphaned_proofs(). Legacy (non content-addressed)
+    paths are ignored.
+    """
+    if not blob_name:
+        return
+    docs = db.collection('proof_blobs') \
+             .where('uid', '==', uid) \
+             .where('blob_name', '==', blob_name) \
+             .limit(1).stream()
+    for doc in docs:
+        _release_proof_blob_txn(db.transaction(), doc.reference)
+
+def replace_activity_proof(uid, activity_id, data, previous_proof):
+    """
+    Update an activity with a proof that was just stored for it. Storing took
+    one reference on data['proof_file']; on success the previous proof's
+    reference is dropped, so re-uploading identical content (the same blob)
+    leaves its count unchanged. If the update fails the new reference is
+    dropped instead.
+    """
+    try:
+        update_activity(uid, activity_id, data)
+    except Exception:
+        release_proof_blob(uid, data.get('proof_file'))
+        raise
+    release_proof_blob(uid, previous_proof)
+
+def get_orphaned_proof_blobs(limit=500):
+    """Return proof records that no activity references any more."""
+    docs = db.collection('proof_blobs').where('ref_count', '<=', 0).limit(limit).stream()
+    return list(docs)
+
+def claim_orphaned_proof_blob(snapshot):
+    """
+    Mark an orphaned proof record as being deleted, if it has not changed
+    since it was read. Claimed records are never re-acquired: a new upload
+    of the same content overwrites the record instead. Returns the claim's
+    update time, or None when a concurrent upload re-acquired it.
+    """
+    try:
+        result = snapshot.reference.update(
+            {'deleting_at': datetime.utcnow()},
+            option=db.write_option(last_update_time=snapshot.update_time)
+        )
+        return result.update_time
+    except Exception:
+        return None
+
+def delete_claimed_proof_blob(ref, claimed_at):
+    """
+    Delete a claimed proof record once its blob is gone. Returns False if the
+    record was overwritten by a new upload after the claim.
+    """
+    try:
+        ref.delete(option=db.write_option(last_update_time=claimed_at))
+        return True
+    except Exception:
+        return False
+
+
 # ========================
 # NEWSLETTER
 # ========================
@@ -359,77 +925,229 @@ def create_event(uid, data, event_type="general"):
         "type": event_type
     }
     doc_ref.set(to_store)
+    bump_collection_version('events')
     return doc_ref.id
 
 def get_all_events(limit=None, event_type=None):
     """
     Get all events, optionally filtered by type.
+    Events whose date has passed are skipped; sweep_expired_events() deletes them.
     """
+    now = datetime.utcnow()
     q = db.collection('events').order_by("created_at", direction=firestore.Query.DESCENDING)
     if event_type:
         q = q.where("type", "==", event_type)
     if limit:
         q = q.limit(limit)
-    return [ {**d.to_dict(), "id": d.id} for d in q.stream() ]
+    events = [{**d.to_dict(), "id": d.id} for d in q.stream()]
+    return [e for e in events if not _is_expired(e.get("date"), now)]
+
+def normalize_event_date(value):
+    """
+    Coerce an event date to a naive UTC datetime, the form Firestore range
+    queries on `date` can match. Accepts datetimes, dates and ISO-8601
+    strings (as sent by n8n); returns None for empty or unparseable values.
+    """
+    if isinstance(value, datetime):
+        parsed = value
+    elif isinstance(value, date):
+        return datetime.combine(value, datetime.min.time())
+    elif isinstance(value, str) and value.strip():
+        try:
+            parsed = datetime.fromisoformat(value.strip())
+        except ValueError:
+            return None
+    else:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def get_upcoming_events(limit=50, start_after_id=None, event_type=None, today=None):
+    """
+    Events from today onwards, soonest first.
+    Only timestamp `date` values match the range filter; see
+    normalize_event_dates() for events stored with ISO-string dates.
+    Filtering by type requires the [type ASC, date ASC] index.
+    Returns (events, next_cursor); next_cursor is None on the last page.
+    """
+    today = today or datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    q = db.collection('events')
+    if event_type:
+        q = q.where(filter=FieldFilter("type", "==", event_type))
+    q = q.where(filter=FieldFilter("date", ">=", today)) \
+         .order_by("date", direction=firestore.Query.ASCENDING).limit(limit)
+
+    if start_after_id:
+        cursor = db.collection('events').document(start_after_id).get()
+        if cursor.exists:
+            q = q.start_after(cursor)
 
-def get_events_by_user(uid):
+    events = [{**d.to_dict(), "id": d.id} for d in q.stream()]
+    next_cursor = events[-1]["id"] if len(events) == limit else None
+    return events, next_cursor
+
+def normalize_event_dates():
+    """
+    Rewrite events whose `date` is stored as a string into timestamps.
+    Returns (updated, unparseable).
+    """
+    updated = unparseable = 0
+    batch = db.batch()
+    pending = 0
+    for doc in db.collection('events').select(['date']).stream():
+        value = (doc.to_dict() or {}).get('date')
+        if not isinstance(value, str):
+            continue
+        normalized = normalize_event_date(value)
+        if normalized is None:
+            unparseable += 1
+            continue
+        batch.update(doc.reference, {'date': normalized})
+        updated += 1
+        pending += 1
+        if pending == 500:  # WriteBatch limit
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    if updated:
+        bump_collection_version('events')
+    return updated, unparseable
+
+def get_events_by_user(uid, limit=50, start_after_id=None):
     """
-    Get events created by a specific user efficiently using Firestore queries.
-    Requires a composite index on [created_by_uid ASC, created_at DESC].
+    Page through the events a user created, newest first.
+    Only that user's documents are read, via the composite index on
+    [created_by_uid ASC, created_at DESC]. Past events are skipped like in
+    get_all_events(). Returns (events, next_cursor); next_cursor is None on
+    the last page.
     """
-    q = db.collection('events').where("created_by_uid", "==", uid).order_by("created_at", direction=firestore.Query.DESCENDING)
-    return [ {**d.to_dict(), "id": d.id} for d in q.stream() ]
+    q = (db.collection('events')
+         .where(filter=FieldFilter("created_by_uid", "==", uid))
+         .order_by("created_at", direction=firestore.Query.DESCENDING)
+         .limit(limit))
+
+    if start_after_id:
+        cursor = db.collection('events').document(start_after_id).get()
+        if cursor.exists and cursor.get('created_by_uid') == uid:
+            q = q.start_after(cursor)
+
+    page = [{**d.to_dict(), "id": d.id} for d in q.stream()]
+    next_cursor = page[-1]["id"] if len(page) == limit else None
+    now = datetime.utcnow()
+    return [e for e in page if not _is_expired(e.get("date"), now)], next_cursor
 
 def get_event(event_id):
     doc = db.collection('events').document(event_id).get()
     return {**doc.to_dict(), "id": doc.id} if doc.exists else None
 
-def update_event(event_id, data):
+def update_event(event_id, data, owner_checked=False):
+    """
+    Update an event owned by the current user. Pass owner_checked=True when
+    the caller has just loaded the event and verified created_by_uid, to
+    skip re-reading it.
+    """
     doc_ref = db.collection('events').document(event_id)
-    doc = doc_ref.get()
-    if not doc.exists or doc.to_dict().get('created_by_uid') != g.uid:
-        return False
+    if not owner_checked:
+        doc = doc_ref.get()
+        if not doc.exists or doc.to_dict().get('created_by_uid') != g.uid:
+            return False
     doc_ref.update(data)
+    bump_collection_version('events')
     return True
 
-def delete_event(event_id):
+def delete_event(event_id, owner_checked=False):
+    """Delete an event owned by the current user (see update_event)."""
     doc_ref = db.collection('events').document(event_id)
-    doc = doc_ref.get()
-    if not doc.exists or doc.to_dict().get('created_by_uid') != g.uid:
-        return False
+    if not owner_checked:
+        doc = doc_ref.get()
+        if not doc.exists or doc.to_dict().get('created_by_uid') != g.uid:
+            return False
     doc_ref.delete()
+    bump_collection_version('events')
     return True
     
+# ========================
+# COLLECTION VERSIONS
+# ========================
+# meta/collection_versions holds {name: {version, updated_at}} for the global,
+# read-mostly collections (events, recommendations). Every write bumps it, and
+# the public feeds derive ETag / Last-Modified from it so an unchanged list is
+# answered with 304 without querying the collection.
+COLLECTION_VERSION_TTL = 5  # seconds a process reuses the version it last read
+_collection_versions = {}  # name -> (fetched_at, version, updated_at)
+
+def bump_collection_version(name):
+    """Record that a global collection changed."""
+    try:
+        db.collection('meta').document('collection_versions').set({
+            name: {'version': firestore.Increment(1), 'updated_at': firestore.SERVER_TIMESTAMP}
+        }, merge=True)
+    except Exception:
+        # best-effort: feeds fall back to a full response at the next TTL
+        pass
+    _collection_versions.pop(name, None)
+
+def get_collection_version(name):
+    """Return (version, updated_at) for a collection; (0, None) if never bumped."""
+    cached = _collection_versions.get(name)
+    if cached and time.monotonic() - cached[0] < COLLECTION_VERSION_TTL:
+        return cached[1], cached[2]
+
+    doc = db.collection('meta').document('collection_versions').get()
+    entry = ((doc.to_dict() or {}) if doc.exists else {}).get(name) or {}
+    version, updated_at = entry.get('version', 0), entry.get('updated_at')
+    _collection_versions[name] = (time.monotonic(), version, updated_at)
+    return version, updated_at
+
 # ========================
 # CLEANUP FUNCTIONS
 # ========================
-def get_all_events(limit=None, event_type=None):
-    """
-    Get all events, optionally filtered by type.
-    Auto-delete expired events based on their 'date' field.
-    """
-    now = datetime.utcnow()
+# Expired events and recommendations are removed by a scheduled sweep
+# (`flask sweep-expired`); read paths only filter them out.
+def _is_expired(value, now):
+    return isinstance(value, datetime) and value.replace(tzinfo=None) < now
 
-    # Remove expired events
-    expired_query = db.collection('events').where("date", "<", now)
-    for doc in expired_query.stream():
-        doc.reference.delete()
+def _bulk_delete(refs):
+    """Delete document references with a BulkWriter; returns (deleted, failed)."""
+    counts = {'deleted': 0, 'failed': 0}
 
-    # Fetch upcoming events
-    q = db.collection('events').order_by("created_at", direction=firestore.Query.DESCENDING)
-    if event_type:
-        q = q.where("type", "==", event_type)
-    if limit:
-        q = q.limit(limit)
-    return [{**d.to_dict(), "id": d.id} for d in q.stream()]
+    def on_result(_ref, _result):
+        counts['deleted'] += 1
 
-def get_user_recommendations(uid):
-    now = datetime.utcnow()
+    def on_error(error, _bulk_writer):
+        # Retry transient failures a few times, then count the document as failed
+        if error.attempts < 3:
+            return True
+        counts['failed'] += 1
+        return False
 
-    # Remove expired recommendations
-    expired_query = db.collection("users").document(uid).collection("recommendations").where("expires_at", "<", now)
-    for doc in expired_query.stream():
-        doc.reference.delete()
+    writer = db.bulk_writer()
+    writer.on_write_result(on_result)
+    writer.on_write_error(on_error)
+    for ref in refs:
+        writer.delete(ref)
+    writer.close()
+    return counts['deleted'], counts['failed']
 
-    docs = db.collection("users").document(uid).collection("recommendations").stream()
-    return [doc.to_dict() | {'id': doc.id} for doc in docs]
+def sweep_expired_events(now=None):
+    """Delete events whose date has passed. Returns (deleted, failed)."""
+    now = now or datetime.utcnow()
+    docs = db.collection('events').where(filter=FieldFilter("date", "<", now)).select([]).stream()
+    deleted, failed = _bulk_delete(doc.reference for doc in docs)
+    if deleted:
+        bump_collection_version('events')
+    return deleted, failed
+
+def sweep_expired_user_recommendations(now=None):
+    """
+    Delete expired recommendations from every user's subcollection.
+    The global `recommendations` collection shares the collection id and is
+    skipped. Returns (deleted, failed).
+    """
+    now = now or datetime.utcnow()
+    docs = db.collection_group('recommendations') \
+             .where(filter=FieldFilter("expires_at", "<", now)).select([]).stream()
+    return _bulk_delete(doc.reference for doc in docs if doc.reference.parent.parent is not None)
@@ -0,0 +1,273 @@
+# services/replica.py
+"""
+Process-local replicas of small, global, read-mostly collections.
+
+`events` and approved `recommendations` are read by most pages but change a
+few times a day. Each worker process seeds an in-memory copy from a Firestore
+on_snapshot listener (the first snapshot delivers every document) and the
+listener keeps it current afterwards, so read routes can be served with zero
+Firestore reads.
+
+Listeners are started lazily on first use in each process, so forked gunicorn
+workers each get their own watch stream. Until the first snapshot arrives the
+accessors return None and callers fall back to querying Firestore.
+
+The SDK retries transient stream errors itself; when it gives up (network
+loss, expired credentials) the watch goes inactive without telling the
+callback. A replica with a dead listener, or one whose snapshot could not be
+applied, is treated as not ready, so callers fall back to Firestore, and the
+next access starts a fresh listener (at most once per RESTART_BACKOFF_SECONDS).
+"""
+import bisect
+import functools
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from .firebase_config import db
+
+logger = logging.getLogger(__name__)
+
+REPLICA_ENABLED = os.environ.get('FIRESTORE_REPLICA', 'True') == 'True'
+RESTART_BACKOFF_SECONDS = 30
+
+
+def _sort_key(value):
+    """Order key for created_at values (datetimes, ISO strings or missing)."""
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return 0.0
+    return 0.0
+
+
+class CollectionReplica:
+    """
+    In-memory mirror of a Firestore query with secondary indexes by
+    authority tag, creator and created_at.
+    """
+
+    def __init__(self, query_factory):
+        self._query_factory = query_factory
+        self._lock = threading.RLock()
+        self._ready = threading.Event()
+        self._watch = None
+        self._pid = None
+        self._generation = 0  # identifies the current listener's callbacks
+        self._failed = False  # a snapshot could not be applied
+        self._next_start = 0.0
+        self.last_snapshot_at = None  # monotonic time of the last applied snapshot
+        self._docs = {}
+        self._by_tag = {}
+        self._by_creator = {}
+        self._order = []  # sorted [(created_at key, doc id)]
+        self._last_update = None  # newest document update_time applied
+        self.version = 0  # bumped on every applied snapshot; never reset
+
+    # ---- lifecycle ----
+    def ensure_started(self):
+        with self._lock:
+            same_process = self._pid == os.getpid()
+            if same_process and self._healthy():
+                return
+            if same_process:
+                if self._ready.is_set():
+                    logger.warning("Replica listener stopped; serving from Firestore until it restarts")
+                self._ready.clear()
+            if same_process and time.monotonic() < self._next_start:
+                return
+            self._next_start = time.monotonic() + RESTART_BACKOFF_SECONDS
+            # First use, after fork, or a dead listener: start a fresh one.
+            # A forked child must not touch the parent's watch threads.
+            old = self._watch if same_process else None
+            self._watch, self._pid = None, None
+            if old is not None:
+                try:
+                    old.unsubscribe()
+                except Exception:
+                    pass
+            self._ready.clear()
+            self._reset()
+            self._failed = False
+            self._generation += 1
+            callback = functools.partial(self._on_snapshot, self._generation)
+            self._watch = self._query_factory().on_snapshot(callback)
+            self._pid = os.getpid()
+
+    def stop(self):
+        with self._lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+            self._watch = None
+            self._pid = None
+            self._generation += 1
+            self._ready.clear()
+
+    def _healthy(self):
+        # Watch.is_active turns False once the stream ends without recovery
+        return self._watch is not None and not self._failed and getattr(self._watch, 'is_active', True)
+
+    def is_ready(self):
+        with self._lock:
+            return self._ready.is_set() and self._healthy()
+
+    def _reset(self):
+        self._docs = {}
+        self._by_tag = {}
+        self._by_creator = {}
+        self._order = []
+        self._last_update = None
+
+    def fingerprint(self):
+        """
+        (state key, last_modified) of the data this replica serves. Every
+        add or update raises the newest update_time and every delete lowers
+        the count, so the key changes with the content; unlike `version` it
+        is the same in every worker that has caught up.
+        """
+        with self._lock:
+            stamp = self._last_update.timestamp() if self._last_update else 0
+            return f"{len(self._docs)}-{stamp}", self._last_update
+
+    # ---- listener ----
+    def _on_snapshot(self, generation, _snapshots, changes, _read_time):
+        with self._lock:
+            if generation != self._generation:
+                return  # late delivery from a listener that has been replaced
+            try:
+                for change in changes:
+                    doc_id = change.document.id
+                    self._remove(doc_id)
+                    if change.type.name != 'REMOVED':
+                        self._add(doc_id, {**change.document.to_dict(), 'id': doc_id})
+                        updated = change.document.update_time
+                        if updated and (self._last_update is None or updated > self._last_update):
+                            self._last_update = updated
+            except Exception:
+                # Partly applied: stop serving it and re-seed on the next access
+                logger.exception("Replica snapshot could not be applied")
+                self._failed = True
+                self._ready.clear()
+                return
+            self.version += 1
+            self.last_snapshot_at = time.monotonic()
+            self._ready.set()
+
+    def _add(self, doc_id, data):
+        self._docs[doc_id] = data
+        for tag in data.get('authority_tags') or []:
+            self._by_tag.setdefault(tag, set()).add(doc_id)
+        creator = data.get('created_by_uid')
+        if creator:
+            self._by_creator.setdefault(creator, set()).add(doc_id)
+        bisect.insort(self._order, (_sort_key(data.get('created_at')), doc_id))
+
+    def _remove(self, doc_id):
+        data = self._docs.pop(doc_id, None)
+        if data is None:
+            return
+        for tag in data.get('authority_tags') or []:
+            ids = self._by_tag.get(tag)
+            if ids:
+                ids.discard(doc_id)
+        creator = data.get('created_by_uid')
+        if creator and creator in self._by_creator:
+            self._by_creator[creator].discard(doc_id)
+        entry = (_sort_key(data.get('created_at')), doc_id)
+        i = bisect.bisect_left(self._order, entry)
+        if i < len(self._order) and self._order[i] == entry:
+            del self._order[i]
+
+    # ---- reads (return copies; routes decorate the dicts) ----
+    def newest(self, limit=None, authorities=None, created_by_uid=None, start_after_id=None):
+        """
+        Documents ordered by created_at descending, optionally restricted to
+        those tagged with any of `authorities` or created by `created_by_uid`,
+        starting after the document `start_after_id` (a paging cursor).
+        """
+        with self._lock:
+            candidates = None
+            if authorities:
+                candidates = set()
+                for tag in authorities:
+                    candidates |= self._by_tag.get(tag, set())
+            if created_by_uid is not None:
+                by_creator = self._by_creator.get(created_by_uid, set())
+                candidates = by_creator if candidates is None else candidates & by_creator
+
+            if candidates is None:
+                ordered = (doc_id for _, doc_id in reversed(self._order))
+            else:
+                # Index hit: only sort the candidate set, not the whole collection
+                ordered = sorted(
+                    candidates,
+                    key=lambda i: (_sort_key(self._docs[i].get('created_at')), i),
+                    reverse=True
+                )
+
+            results = []
+            skipping = start_after_id is not None and start_after_id in self._docs
+            for doc_id in ordered:
+                if skipping:
+                    skipping = doc_id != start_after_id
+                    continue
+                results.append(dict(self._docs[doc_id]))
+                if limit and len(results) >= limit:
+                    break
+            return results
+
+
+    def upcoming(self, since, limit=None, start_after_id=None):
+        """
+        Documents whose `date` is on or after `since`, soonest first
+        (the in-memory counterpart of models.get_upcoming_events). As in
+        the Firestore query, only timestamp dates are considered; `since`
+        should be timezone-aware.
+        """
+        floor = _sort_key(since)
+        with self._lock:
+            dated = sorted(
+                (_sort_key(d['date']), doc_id) for doc_id, d in self._docs.items()
+                if isinstance(d.get('date'), datetime) and _sort_key(d['date']) >= floor
+            )
+            results = []
+            skipping = start_after_id is not None and start_after_id in self._docs
+            for _, doc_id in dated:
+                if skipping:
+                    skipping = doc_id != start_after_id
+                    continue
+                results.append(dict(self._docs[doc_id]))
+                if limit and len(results) >= limit:
+                    break
+            return results
+
+
+_events = CollectionReplica(lambda: db.collection('events'))
+_recommendations = CollectionReplica(
+    lambda: db.collection('recommendations').where('approved', '==', True)
+)
+
+
+def _ready_replica(replica):
+    if not REPLICA_ENABLED:
+        return None
+    try:
+        replica.ensure_started()
+    except Exception:
+        return None
+    return replica if replica.is_ready() else None
+
+
+def events_replica():
+    """Return the live events replica, or None if it is disabled, seeding or its listener is down."""
+    return _ready_replica(_events)
+
+
+def recommendations_replica():
+    """Return the live approved-recommendations replica, or None if unavailable."""
+    return _ready_replica(_recommendations)
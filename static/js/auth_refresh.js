@@ -2,9 +2,18 @@
  * Enterprise Auth Handler
  * Automatically syncs Firebase ID Token with the Flask Backend Session.
  * Prevents "500 Internal Server Error" when token expires after 1 hour.
+ *
+ * In session-cookie mode (FIREBASE_SESSION_COOKIES=True) the server issues a
+ * long-lived Firebase session cookie at login, so refreshed ID tokens do not
+ * need to be posted back and this handler stays idle.
  */
 
 document.addEventListener('DOMContentLoaded', function() {
+    const mode = document.querySelector('meta[name="session-mode"]');
+    if (mode && mode.content === 'cookie') {
+        return;
+    }
+
     if (typeof firebase === 'undefined' || !firebase.auth) {
         console.error("Firebase SDK not loaded. Token sync disabled.");
         return;
@@ -0,0 +1,103 @@
+"""
+Reference counting of content-addressed proof files across activity edits.
+
+Firestore and Cloud Storage are replaced with an in-memory proof_blobs
+table, so this runs without Firebase credentials.
+"""
+
+import io
+import sys
+import types
+from unittest import mock
+
+import pytest
+
+# services.firebase_config connects to Firebase on import
+sys.modules.setdefault('services.firebase_config', types.SimpleNamespace(db=mock.MagicMock()))
+
+from core import upload_pipeline  # noqa: E402
+from services import models  # noqa: E402
+
+UID = 'user-1'
+PDF = b'%PDF-1.4\n' + b'x' * 2048
+
+
+class FakeProofBlobs:
+    """proof_blobs records keyed by sha256, with the model functions' semantics."""
+
+    def __init__(self):
+        self.records = {}
+
+    def acquire(self, uid, sha256):
+        record = self.records.get(sha256)
+        if not record:
+            return None
+        record['ref_count'] += 1
+        return record['blob_name']
+
+    def register(self, uid, upload):
+        self.records[upload['sha256']] = {'blob_name': upload['blob_name'], 'ref_count': 1}
+        return upload['blob_name']
+
+    def release(self, uid, blob_name):
+        for record in self.records.values():
+            if record['blob_name'] == blob_name:
+                record['ref_count'] -= 1
+
+    def ref_count(self, blob_name):
+        return next(r['ref_count'] for r in self.records.values() if r['blob_name'] == blob_name)
+
+
+def fake_stream_upload(file_obj, blob_path):
+    """stream_upload without Cloud Storage: validate and hash only."""
+    return dict(upload_pipeline.scan_upload(file_obj), blob_name=blob_path, generation=1)
+
+
+@pytest.fixture
+def blobs(monkeypatch):
+    fake = FakeProofBlobs()
+    monkeypatch.setattr(upload_pipeline, 'acquire_proof_blob', fake.acquire)
+    monkeypatch.setattr(upload_pipeline, 'register_proof_blob', fake.register)
+    monkeypatch.setattr(upload_pipeline, 'stream_upload', fake_stream_upload)
+    monkeypatch.setattr(models, 'release_proof_blob', fake.release)
+    return fake
+
+
+def test_reupload_of_identical_proof_keeps_ref_count(blobs, monkeypatch):
+    updates = []
+    monkeypatch.setattr(models, 'update_activity', lambda uid, aid, data: updates.append(data))
+
+    original = upload_pipeline.store_proof_file(UID, io.BytesIO(PDF))
+    assert blobs.ref_count(original) == 1
+
+    # Edit the activity and attach the same bytes again
+    again = upload_pipeline.store_proof_file(UID, io.BytesIO(PDF))
+    assert again == original
+    models.replace_activity_proof(UID, 'a1', {'proof_file': again}, original)
+
+    assert updates == [{'proof_file': original}]
+    assert blobs.ref_count(original) == 1
+
+
+def test_replaced_proof_moves_reference(blobs, monkeypatch):
+    monkeypatch.setattr(models, 'update_activity', lambda uid, aid, data: None)
+
+    original = upload_pipeline.store_proof_file(UID, io.BytesIO(PDF))
+    replacement = upload_pipeline.store_proof_file(UID, io.BytesIO(PDF + b'v2'))
+    models.replace_activity_proof(UID, 'a1', {'proof_file': replacement}, original)
+
+    assert blobs.ref_count(original) == 0
+    assert blobs.ref_count(replacement) == 1
+
+
+def test_failed_update_releases_new_reference(blobs, monkeypatch):
+    def fail(uid, aid, data):
+        raise ValueError('activity gone')
+    monkeypatch.setattr(models, 'update_activity', fail)
+
+    original = upload_pipeline.store_proof_file(UID, io.BytesIO(PDF))
+    again = upload_pipeline.store_proof_file(UID, io.BytesIO(PDF))
+    with pytest.raises(ValueError):
+        models.replace_activity_proof(UID, 'a1', {'proof_file': again}, original)
+
+    assert blobs.ref_count(original) == 1